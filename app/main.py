@@ -1,15 +1,63 @@
 import logging
 import sys
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from app.src.view import router
-from app.src.authview import auth_router
+import traceback
+from contextlib import asynccontextmanager
+
+from app.src.modules import startup
+
+# Timed group by group in dependency order, a group only counts the modules
+# that the groups before it did not load
+with startup.timed("import fastapi"):
+    from fastapi import FastAPI
+    from fastapi.middleware.cors import CORSMiddleware
+with startup.timed("import databases (sqlalchemy, psycopg, langchain_postgres, firebase)"):
+    from app.src.modules.databases import ConversationDB, PGVectorManager
+    from app.src.modules.http_client import close_http_clients
+with startup.timed("import ehr_db (aiomysql)"):
+    from app.src.modules.ehr_db import EHRDatabase
+with startup.timed("import services (langchain agents, bedrock)"):
+    from app.src.modules.services import LLMAgentFactory
+with startup.timed("import routes"):
+    from app.src.view import router
+    from app.src.authview import auth_router
+with startup.timed("import uvicorn"):
+    import uvicorn
 from app.src.constants import FIREBASE_API_KEY, GOOGLE_APPLICATION_CREDENTIALS, OPENAI_API_KEY
-import uvicorn
 import os
 from dotenv import load_dotenv
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger = logging.getLogger("uvicorn.access")
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+
+    # Clients connect on first use (MySQL, Redis, Firebase, vector store engines),
+    # the pool only starts connecting here so a slow database doesn't hold up the worker
+    with startup.timed("conversation db pool"):
+        await ConversationDB().open()
+    # Prompts, tools and executors only, building them makes no API call
+    with startup.timed("agent runtimes"):
+        try:
+            await LLMAgentFactory().prebuild()
+        except Exception:
+            # Not fatal, e.g. without OPENAI_API_KEY: requests build the agents on
+            # first use and only those fail
+            logging.getLogger("main").error(traceback.format_exc())
+    logging.getLogger("main").info(f"Startup report: {startup.report()}")
+
+    yield
+
+    await ConversationDB().close()
+    await PGVectorManager().dispose()
+    await EHRDatabase().close()
+    await close_http_clients()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(router)
 app.include_router(auth_router)
 
@@ -38,15 +86,6 @@ def check_environment(env_variables, logger: logging.Logger):
             logger.info(f"{env_var} is set as {os.getenv(env_var)}")
 
 
-@app.on_event("startup")
-async def startup_event():
-    logger = logging.getLogger("uvicorn.access")
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(handler)
-
-
 if __name__ == '__main__':
     load_dotenv()
 
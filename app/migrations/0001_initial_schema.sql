@@ -0,0 +1,138 @@
+-- Schema previously created by ConversationDB at startup. Every statement is
+-- IF NOT EXISTS so databases created that way can apply it as a baseline.
+
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS queries (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    Convo_ID TEXT,
+    Question TEXT,
+    Answer TEXT,
+    Prompt TEXT,
+    timestamp timestamp default current_timestamp,
+    response_time double precision,
+    rating integer,
+    review text,
+    user_id TEXT
+);
+
+CREATE TABLE IF NOT EXISTS hr_questions (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    convo_ID TEXT,
+    Question TEXT,
+    Answer TEXT,
+    context TEXT,
+    created_at timestamp default current_timestamp,
+    response_time double precision,
+    rating integer,
+    review text,
+    user_id TEXT
+);
+
+CREATE TABLE IF NOT EXISTS Users (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    designation TEXT,
+    department TEXT,
+    role TEXT,
+    firebase_uid TEXT,
+    created_at timestamp default current_timestamp,
+    updated_at timestamp default current_timestamp,
+    last_login timestamp,
+    last_session_duration double precision
+);
+
+CREATE TABLE IF NOT EXISTS AllowedEmails (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    role TEXT,
+    allowed_by TEXT not null,
+    created_at timestamp default current_timestamp,
+    updated_at timestamp default current_timestamp
+);
+
+CREATE TABLE IF NOT EXISTS AllowedDomains (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    domain_name Text,
+    allowed_by TEXT not null,
+    created_at timestamp default current_timestamp,
+    updated_at timestamp default current_timestamp
+);
+
+CREATE TABLE IF NOT EXISTS conversation (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    user_id text not null,
+    first_question Text,
+    description TEXT,
+    created_at timestamp default current_timestamp
+);
+
+CREATE TABLE IF NOT EXISTS docProcTemplates (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    user_id text not null,
+    template_name Text,
+    attributes TEXT,
+    created_at timestamp default current_timestamp
+);
+
+CREATE TABLE IF NOT EXISTS allowedips (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    ip_address TEXT,
+    created_at timestamp default current_timestamp,
+    updated_at timestamp default current_timestamp
+);
+
+CREATE TABLE IF NOT EXISTS parentdocuments (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    parent_document TEXT,
+    created_at timestamp default current_timestamp
+);
+
+CREATE TABLE IF NOT EXISTS prompts (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    llm_model TEXT,
+    persona TEXT,
+    glossary TEXT,
+    tone TEXT,
+    response_length TEXT,
+    content TEXT,
+    created_at timestamp DEFAULT current_timestamp,
+    updated_at timestamp DEFAULT current_timestamp
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
+    file_name text NOT NULL,
+    url text NOT NULL,
+    user_id text NOT NULL,
+    created_at timestamp DEFAULT current_timestamp,
+    updated_at timestamp DEFAULT current_timestamp,
+    active boolean DEFAULT true
+);
+
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    content_hash text PRIMARY KEY,
+    model text NOT NULL,
+    embedding real[] NOT NULL,
+    created_at timestamp DEFAULT current_timestamp
+);
+
+-- The vector store tables as langchain_postgres creates them, so the search
+-- columns and indexes of the next migrations have a table to go on
+CREATE TABLE IF NOT EXISTS langchain_pg_collection (
+    uuid uuid PRIMARY KEY,
+    name varchar NOT NULL UNIQUE,
+    cmetadata json
+);
+
+CREATE TABLE IF NOT EXISTS langchain_pg_embedding (
+    id varchar PRIMARY KEY,
+    collection_id uuid REFERENCES langchain_pg_collection (uuid) ON DELETE CASCADE,
+    embedding vector,
+    document varchar,
+    cmetadata jsonb
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_langchain_pg_embedding_id ON langchain_pg_embedding (id);
@@ -0,0 +1,31 @@
+-- migrate: no-transaction
+-- migrate: maintenance-window
+-- Full text search column and metadata indexes of langchain_pg_embedding.
+--
+-- Adding the stored generated column rewrites the whole table under an ACCESS
+-- EXCLUSIVE lock: ingestion and searches are blocked until it is done, so this
+-- migration is only applied with migrate --maintenance. The indexes are then
+-- built concurrently, while ingestion and searches run.
+
+-- Computed by Postgres on every insert, the ingestion paths don't write it
+ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS document_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english'::regconfig, coalesce(document, ''))) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_langchain_pg_embedding_document_tsv
+    ON langchain_pg_embedding USING gin (document_tsv);
+
+-- Metadata filters (active, source $in, ...) are jsonb containment. Same name as the
+-- index langchain_postgres creates, so tables that have it keep one copy
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_cmetadata_gin
+    ON langchain_pg_embedding USING gin (cmetadata jsonb_path_ops);
+
+-- Per-file deletes and updates match the source exactly, within a collection or not
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_langchain_pg_embedding_collection_source
+    ON langchain_pg_embedding (collection_id, (cmetadata ->> 'source'));
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_langchain_pg_embedding_source
+    ON langchain_pg_embedding ((cmetadata ->> 'source'));
+
+-- get_file_names_by_collection
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_langchain_pg_embedding_collection_name
+    ON langchain_pg_embedding ((cmetadata ->> 'collection_name'), (cmetadata ->> 'source'));
@@ -0,0 +1,12 @@
+-- migrate: no-transaction
+-- Indexes for the conversation, history and login lookups.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_queries_convo_id ON queries (convo_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_queries_timestamp ON queries (timestamp);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_conversation_user_id ON conversation (user_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email ON users (email);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_hr_questions_convo_id ON hr_questions (convo_id);
@@ -0,0 +1,8 @@
+-- Copy files.active into the metadata of the embeddings ingested before searches
+-- filtered on it. toggle_file_active keeps both in sync afterwards.
+
+UPDATE langchain_pg_embedding e
+SET cmetadata = jsonb_set(e.cmetadata, '{active}', to_jsonb(f.active))
+FROM files f
+WHERE e.cmetadata ->> 'source' = f.file_name
+AND e.cmetadata -> 'active' IS DISTINCT FROM to_jsonb(f.active);
@@ -11,6 +11,76 @@ ADMIN_ROLE = "Admin"
 EMPLOYEE_ROLE = "Employee"
 
 EMBEDDINGS_MODEL = "text-embedding-3-large"
+# Embedding size of new collections, None keeps the model's native size.
+# Existing collections are converted with python -m app.src.modules.embedding_storage
+EMBEDDINGS_DIMENSIONS = None
+# How long a worker trusts its lookup of a collection's embedding size
+COLLECTION_LOOKUP_TTL = 60
+
+# Conversation db connection pool defaults, overridable with PG_POOL_* env vars
+PG_POOL_MIN_SIZE = 2
+PG_POOL_MAX_SIZE = 10
+PG_POOL_MAX_IDLE = 300
+PG_POOL_TIMEOUT = 30
+
+# EHR MySQL connection pool defaults, overridable with MYSQL_POOL_* env vars
+MYSQL_POOL_MIN_SIZE = 1
+MYSQL_POOL_MAX_SIZE = 10
+MYSQL_POOL_RECYCLE = 1800
+MYSQL_CONNECT_TIMEOUT = 10
+
+# Encounter data cache of the get_encounter_data tool, overridable with ENCOUNTER_CACHE_* env vars
+ENCOUNTER_CACHE_TTL = 300
+ENCOUNTER_CACHE_SIZE = 256
+
+# Size of the encounter data sent to the LLM: token budget of the whole tool
+# result, share of it kept for the encounters, and characters kept of a free text field
+ENCOUNTER_DATA_TOKEN_BUDGET = 2000
+ENCOUNTER_DATA_ENCOUNTERS_SHARE = 0.6
+ENCOUNTER_TEXT_MAX_CHARS = 300
+
+# HTTP client shared by the OpenAI chat and embeddings clients, overridable with
+# OPENAI_HTTP_* env vars (seconds for the timeouts and the keep-alive expiry)
+OPENAI_HTTP_MAX_CONNECTIONS = 100
+OPENAI_HTTP_MAX_KEEPALIVE = 20
+OPENAI_HTTP_KEEPALIVE_EXPIRY = 60
+OPENAI_HTTP_CONNECT_TIMEOUT = 5
+OPENAI_HTTP_TIMEOUT = 60
+
+# Turns of history a WebSocket chat session keeps and sends to the agent
+CHAT_SESSION_HISTORY_TURNS = 20
+
+# Knowledge base search of the user's input started with the first LLM call of a
+# turn, reused by one semantic_search call whose term has this Jaccard similarity
+# with the input. Off by default: when on, every turn pays an extra query embedding
+# and hybrid search, encounter and small talk turns included
+SPECULATIVE_SEARCH = False
+SPECULATIVE_SEARCH_MIN_SIMILARITY = 0.6
+
+# Vector store engine pool defaults, overridable with VECTORSTORE_* env vars
+VECTORSTORE_POOL_SIZE = 5
+VECTORSTORE_MAX_OVERFLOW = 5
+VECTORSTORE_POOL_RECYCLE = 1800
+
+# Query embedding cache, overridable with QUERY_EMBEDDING_* env vars
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+QUERY_EMBEDDING_CACHE_TTL = 3600
+QUERY_EMBEDDING_REDIS_TTL = 86400
+
+# Retrieval results are invalidated by collection epochs, the TTL only bounds memory
+RETRIEVAL_CACHE_TTL = 86400
+
+# ANN index build defaults, and how long a worker trusts its lookup of a collection's index
+VECTOR_INDEX_HNSW_M = 16
+VECTOR_INDEX_HNSW_EF_CONSTRUCTION = 64
+VECTOR_INDEX_LOOKUP_TTL = 300
+
+# Hybrid retrieval: text search configuration of the queries, which must be the one
+# migration 0002 builds the tsvector column with (changing it takes a migration),
+# candidates fetched from each search per result, and the reciprocal rank fusion constant
+FULL_TEXT_SEARCH_CONFIG = "english"
+HYBRID_SEARCH_FETCH_FACTOR = 4
+HYBRID_SEARCH_RRF_K = 60
 
 OPENAI_MODELS = ["gpt-3.5-turbo-0125", "gpt-4o", "gpt-4o-mini", "gpt-3.5-turbo"]
 BEDROCK_MODELS = ["meta.llama3-1-70b-instruct-v1:0"]
@@ -1,4 +1,4 @@
-from typing import Union, Optional
+from typing import List, Union, Optional
 from pydantic import BaseModel
 import uuid
 
@@ -120,6 +120,11 @@ class DeleteFile(BaseModel):
     file_name: str
 
 
+class DeleteFiles(BaseModel):
+    file_names: List[str]
+    collection_name: Optional[str] = None
+
+
 class ActiveFile(BaseModel):
     file_name: str
     active: bool
@@ -151,3 +156,11 @@ class TreatmentPlanRequest(BaseModel):
     reference_number: Optional[str] = None
     language: Optional[str] = None
 
+
+class VectorIndexRequest(BaseModel):
+    collection_name: str
+    method: Optional[str] = "hnsw"
+    m: Optional[int] = None
+    ef_construction: Optional[int] = None
+    lists: Optional[int] = None
+    vector_type: Optional[str] = None
@@ -1 +1,3 @@
 ROLE_CHANGE_FAILED = "Failed to change role"
+CHAT_TURN_FAILED = "I apologize, but I encountered an error processing your request. Please try again."
+INVALID_CHAT_MESSAGE = "Messages must be JSON text frames"
@@ -6,6 +6,7 @@ import traceback
 import urllib.parse
 import logging
 import asyncio
+from datetime import datetime, timezone
 
 from fastapi import HTTPException, UploadFile
 from tqdm import tqdm
@@ -15,7 +16,8 @@ import pymupdf4llm
 from app.src.constants import UPLOAD_PATH, IMAGES_DIRECTORY
 import app.src.constants as constants
 from app.src.modules.aws import AWS
-from app.src.modules.databases import PGVectorManager
+from app.src.modules.cache import get_retrieval_cache
+from app.src.modules.databases import ConversationDB, PGVectorManager
 
 logger = logging.getLogger("knowledge_base")
 
@@ -173,23 +175,36 @@ async def ingest_file(file, collection_name=None):
         else:
             collection_name = os.environ.get("VECTORSTORE_COLLECTION_NAME")
 
-    vectorstoremanager = PGVectorManager()
-    vectorstore = vectorstoremanager.return_vector_store(
-        collection_name, True)
     logger.info(f"Adding documents to {collection_name} for {filepath}")
-    logger.info(f"Vector store created successfully, attempting to add {len(docs)} documents")
+    await add_documents(collection_name, docs)
+    logger.info(f"Successfully added all documents to {collection_name} for {filepath}")
+
+
+async def add_documents(collection_name, docs, batch_size=50):
+    """add documents to a collection in batches, leasing the vector store per batch"""
+    vectorstoremanager = PGVectorManager()
+    logger.info(f"Attempting to add {len(docs)} documents to {collection_name}")
+    ingested_at = datetime.now(timezone.utc).isoformat()
+    # New files are active, a file uploaded again keeps its flag, and
+    # toggle_file_active keeps it in sync afterwards
+    db = ConversationDB()
+    active = {}
+    for source in {doc.metadata.get("source") for doc in docs}:
+        active[source] = await db.get_file_active(source) if source else True
+    for doc in docs:
+        doc.metadata["active"] = active[doc.metadata.get("source")]
+        doc.metadata["ingested_at"] = ingested_at
     try:
-        # Process documents in batches of 50
-        batch_size = 50
         for i in range(0, len(docs), batch_size):
             batch = docs[i:i + batch_size]
             logger.info(f"Processing batch {i//batch_size + 1} of {(len(docs) + batch_size - 1)//batch_size}")
             try:
-                # Add timeout to the operation
-                await asyncio.wait_for(
-                    vectorstore.aadd_documents(batch),
-                    timeout=30  # 30 second timeout
-                )
+                async with vectorstoremanager.lease(collection_name, write=True) as vectorstore:
+                    # Add timeout to the operation
+                    await asyncio.wait_for(
+                        vectorstore.aadd_documents(batch),
+                        timeout=30  # 30 second timeout
+                    )
                 logger.info(f"Successfully added batch {i//batch_size + 1}")
             except asyncio.TimeoutError:
                 logger.error(f"Timeout while processing batch {i//batch_size + 1}")
@@ -198,14 +213,13 @@ async def ingest_file(file, collection_name=None):
                 logger.error(f"Error processing batch {i//batch_size + 1}: {str(e)}")
                 logger.error(f"First document in failed batch: {batch[0].page_content[:200]}...")
                 raise
-        
-        logger.info(f"Successfully added all documents to {collection_name} for {filepath}")
     except Exception as e:
         logger.error(f"Error adding documents: {str(e)}")
         logger.error(traceback.format_exc())
         raise
     finally:
-        vectorstoremanager.close()
+        # Even a partial ingestion changes what searches return
+        await get_retrieval_cache().bump_epoch(collection_name)
 
 
 async def create_drug_index(files):
@@ -325,45 +339,15 @@ async def process_file(file: UploadFile, collection_name: str = "drug-index"):
             d.page_content = cleaned_text
 
         logger.info(f"Adding documents to {collection_name} for {file.filename}")
-        vectorstoremanager = PGVectorManager()
-        vectorstore = vectorstoremanager.return_vector_store(
-            collection_name, True)
-        
+
         # Debug logging for documents
         logger.info(f"Number of documents to add: {len(docs)}")
         for i, doc in enumerate(docs[:2]):  # Log first 2 documents as sample
             logger.info(f"Document {i} content length: {len(doc.page_content)}")
             logger.info(f"Document {i} metadata: {doc.metadata}")
-        
-        logger.info(f"Vector store created successfully, attempting to add {len(docs)} documents")
-        try:
-            # Process documents in batches of 50
-            batch_size = 50
-            for i in range(0, len(docs), batch_size):
-                batch = docs[i:i + batch_size]
-                logger.info(f"Processing batch {i//batch_size + 1} of {(len(docs) + batch_size - 1)//batch_size}")
-                try:
-                    # Add timeout to the operation
-                    await asyncio.wait_for(
-                        vectorstore.aadd_documents(batch),
-                        timeout=30  # 30 second timeout
-                    )
-                    logger.info(f"Successfully added batch {i//batch_size + 1}")
-                except asyncio.TimeoutError:
-                    logger.error(f"Timeout while processing batch {i//batch_size + 1}")
-                    raise Exception(f"Timeout while processing batch {i//batch_size + 1}")
-                except Exception as e:
-                    logger.error(f"Error processing batch {i//batch_size + 1}: {str(e)}")
-                    logger.error(f"First document in failed batch: {batch[0].page_content[:200]}...")
-                    raise
-            
-            logger.info(f"Successfully added all documents to {collection_name} for {file.filename}")
-        except Exception as e:
-            logger.error(f"Error adding documents: {str(e)}")
-            logger.error(traceback.format_exc())
-            raise
-        finally:
-            vectorstoremanager.close()
+
+        await add_documents(collection_name, docs)
+        logger.info(f"Successfully added all documents to {collection_name} for {file.filename}")
         
         # Clean up local file
         if os.path.exists(file_path):
@@ -372,7 +356,6 @@ async def process_file(file: UploadFile, collection_name: str = "drug-index"):
         logger.info(f"Completed processing file: {file.filename}")
         
         # Add file to database
-        from app.src.modules.databases import ConversationDB
         db = ConversationDB()
         await db.add_files([{"filename": file.filename, "url": url}], user_id=1)
         
@@ -10,6 +10,7 @@ from firebase_admin import auth
 from firebase_admin.auth import UserRecord
 from requests.exceptions import HTTPError
 import app.src.constants as constants
+from app.src.modules import startup
 
 
 def raise_detailed_error(request_object):
@@ -26,8 +27,9 @@ class Authentication:
         if not firebase_admin._apps:
             path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
             print(path)
-            cred = firebase_admin.credentials.Certificate(path)
-            self.default_app = firebase_admin.initialize_app(credential=cred)
+            with startup.timed("firebase app"):
+                cred = firebase_admin.credentials.Certificate(path)
+                self.default_app = firebase_admin.initialize_app(credential=cred)
         self.logger = logging.getLogger("Authentication")
         self.api_key = os.getenv(constants.FIREBASE_API_KEY)
 
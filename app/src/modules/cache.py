@@ -0,0 +1,273 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+
+from langchain_core.documents import Document
+from redis import asyncio as aioredis
+
+from app.src import constants
+
+logger = logging.getLogger("cache")
+
+# Epoch field bumped when a change cannot be tied to a single collection
+ALL_COLLECTIONS = "*"
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so that whitespace and unicode differences hash the same"""
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class LRUTier:
+    """In-process tier of the two tier caches: an LRU of at most max_size entries,
+    each kept for ttl seconds"""
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard_prefix(self, prefix: str) -> None:
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            del self.entries[key]
+
+
+def tier_stats(stats: dict, local: LRUTier) -> dict:
+    """Counters of a two tier cache with its hit rate and the size of its LRU"""
+    lookups = sum(stats.values())
+    hits = stats["lru_hits"] + stats["redis_hits"]
+    return {
+        **stats,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "lru_size": len(local),
+    }
+
+
+def filter_hash(search_filter: Optional[dict]) -> str:
+    """Stable hash of a metadata filter, list values are compared as sets"""
+    def canonical(value):
+        if isinstance(value, dict):
+            return {k: canonical(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple, set)):
+            return sorted(canonical(v) for v in value)
+        return value
+
+    payload = json.dumps(canonical(search_filter or {}), sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RetrievalCache:
+    """Redis cache of similarity search results.
+
+    Keys carry the epoch of the collection, and every knowledge base change bumps
+    the epoch, so results cached before the change can no longer be looked up.
+    """
+
+    def __init__(self, redis_url: Optional[str], ttl: int) -> None:
+        self.redis = aioredis.from_url(
+            redis_url, encoding="utf-8", decode_responses=True) if redis_url else None
+        self.ttl = ttl
+        self.prefix = f"{os.environ.get('PROJECT_NAME')}:retrieval"
+        self.epochs_key = f"{self.prefix}:epochs"
+
+    async def get_epoch(self, collection_name: str) -> str:
+        collection_epoch, global_epoch = await self.redis.hmget(
+            self.epochs_key, collection_name, ALL_COLLECTIONS)
+        return f"{global_epoch or 0}.{collection_epoch or 0}"
+
+    async def bump_epoch(self, collection_name: Optional[str] = None) -> None:
+        """Invalidate the cached results of a collection, or of every collection"""
+        if self.redis is None:
+            return
+        try:
+            await self.redis.hincrby(
+                self.epochs_key, collection_name or ALL_COLLECTIONS, 1)
+            logger.info(f"Bumped retrieval cache epoch of {collection_name or 'all collections'}")
+        except Exception as err:
+            logger.error(f"Retrieval cache: failed to bump epoch of {collection_name}: {err}")
+
+    async def key(self, collection_name: str, query: str, k: int, search_filter: Optional[dict],
+                  search_params: Optional[dict] = None) -> Optional[str]:
+        """Cache key of a search, computed before the search runs so that results of a
+        search that raced with an epoch bump are stored under the old epoch"""
+        if self.redis is None:
+            return None
+        try:
+            epoch = await self.get_epoch(collection_name)
+        except Exception as err:
+            logger.warning(f"Retrieval cache: failed to read epoch: {err}")
+            return None
+        query_digest = hashlib.sha256(
+            normalize_text(query).casefold().encode("utf-8")).hexdigest()
+        key = f"{self.prefix}:{collection_name}:{epoch}:{filter_hash(search_filter)}:{query_digest}:{k}"
+        # Only the parameters that are set, so the default search keeps its keys
+        params = {name: value for name, value in (search_params or {}).items() if value is not None}
+        if params:
+            key += ":" + filter_hash(params)
+        return key
+
+    async def get(self, key: Optional[str]) -> Optional[List[Document]]:
+        if key is None:
+            return None
+        try:
+            cached = await self.redis.get(key)
+        except Exception as err:
+            logger.warning(f"Retrieval cache: redis get failed: {err}")
+            return None
+        if cached is None:
+            return None
+        return [Document(page_content=doc["page_content"], metadata=doc["metadata"])
+                for doc in json.loads(cached)]
+
+    async def set(self, key: Optional[str], docs: List[Document]) -> None:
+        if key is None:
+            return
+        payload = json.dumps([{"page_content": doc.page_content, "metadata": doc.metadata}
+                              for doc in docs])
+        try:
+            await self.redis.set(key, payload, ex=self.ttl)
+        except Exception as err:
+            logger.warning(f"Retrieval cache: redis set failed: {err}")
+
+
+retrieval_cache = None
+
+
+def get_retrieval_cache() -> RetrievalCache:
+    """Process-wide retrieval cache, created on first use"""
+    global retrieval_cache
+    if retrieval_cache is None:
+        retrieval_cache = RetrievalCache(
+            redis_url=os.environ.get("REDIS_URL"),
+            ttl=int(os.getenv("RETRIEVAL_CACHE_TTL", constants.RETRIEVAL_CACHE_TTL)),
+        )
+    return retrieval_cache
+
+
+def jsonable(value):
+    """Round trip through json, so that cached and freshly loaded rows look the same
+    (dates, times and decimals of the EHR rows become strings)"""
+    return json.loads(json.dumps(value, default=str))
+
+
+class EncounterCache:
+    """Two tier cache of the encounter data of patients: an in-process LRU in
+    front of Redis, both with a short TTL.
+
+    Like the retrieval cache, keys carry an epoch of the patient that
+    invalidate() bumps, so an EHR write also invalidates the in-process tier of
+    the other workers.
+    """
+
+    def __init__(self, redis_url: Optional[str], ttl: int, max_size: int) -> None:
+        self.redis = aioredis.from_url(
+            redis_url, encoding="utf-8", decode_responses=True) if redis_url else None
+        self.ttl = ttl
+        self.max_size = max_size
+        self.local = LRUTier(max_size, ttl)
+        self.patient_ids = {}
+        self.prefix = f"{os.environ.get('PROJECT_NAME')}:encounters"
+        self.epochs_key = f"{self.prefix}:epochs"
+        self.stats = {"lru_hits": 0, "redis_hits": 0, "misses": 0}
+
+    async def key(self, patient_id) -> str:
+        """Cache key of a patient, computed before loading the data so that data
+        loaded while the EHR wrote is stored under the old epoch"""
+        epoch = 0
+        if self.redis is not None:
+            try:
+                epoch = await self.redis.hget(self.epochs_key, str(patient_id)) or 0
+            except Exception as err:
+                logger.warning(f"Encounter cache: failed to read epoch: {err}")
+        return f"{self.prefix}:{patient_id}:{epoch}"
+
+    def get_patient_id(self, user_id):
+        """Patient id of a user, which does not change, found by an earlier lookup"""
+        return self.patient_ids.get(user_id)
+
+    def set_patient_id(self, user_id, patient_id) -> None:
+        if len(self.patient_ids) >= self.max_size:
+            self.patient_ids.clear()
+        self.patient_ids[user_id] = patient_id
+
+    async def get(self, key: str) -> Optional[dict]:
+        data = self.local.get(key)
+        if data is not None:
+            self.stats["lru_hits"] += 1
+            return data
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(key)
+            except Exception as err:
+                logger.warning(f"Encounter cache: redis get failed: {err}")
+                cached = None
+            if cached is not None:
+                data = json.loads(cached)
+                self.local.set(key, data)
+                self.stats["redis_hits"] += 1
+                return data
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, data: dict) -> None:
+        """data is expected to be jsonable, the tiers must return the same thing"""
+        self.local.set(key, data)
+        if self.redis is not None:
+            try:
+                await self.redis.set(key, json.dumps(data), ex=self.ttl)
+            except Exception as err:
+                logger.warning(f"Encounter cache: redis set failed: {err}")
+
+    async def invalidate(self, patient_id) -> None:
+        """Drop the cached encounter data of a patient, in every worker"""
+        self.local.discard_prefix(f"{self.prefix}:{patient_id}:")
+        if self.redis is not None:
+            await self.redis.hincrby(self.epochs_key, str(patient_id), 1)
+            # Epochs only need to outlive the entries keyed by them
+            await self.redis.expire(self.epochs_key, self.ttl + 86400)
+        logger.info(f"Invalidated the cached encounter data of patient {patient_id}")
+
+    def get_stats(self) -> dict:
+        return tier_stats(self.stats, self.local)
+
+
+encounter_cache = None
+
+
+def get_encounter_cache() -> EncounterCache:
+    """Process-wide encounter cache, created on first use"""
+    global encounter_cache
+    if encounter_cache is None:
+        encounter_cache = EncounterCache(
+            redis_url=os.environ.get("REDIS_URL"),
+            ttl=int(os.getenv("ENCOUNTER_CACHE_TTL", constants.ENCOUNTER_CACHE_TTL)),
+            max_size=int(os.getenv("ENCOUNTER_CACHE_SIZE", constants.ENCOUNTER_CACHE_SIZE)),
+        )
+    return encounter_cache
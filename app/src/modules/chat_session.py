@@ -0,0 +1,50 @@
+import logging
+import os
+from typing import List, Optional
+
+from app.src import constants
+from app.src.modules.databases import ConversationDB
+from app.src.modules.services import LLMAgentFactory
+
+
+class ChatSession:
+    """State of a WebSocket chat, kept across its turns: the conversation id and a
+    rolling window of its history, so turns after the first read nothing from the
+    queries table. Agents are shared by the worker, the session only looks its own up
+    again when the language changes. Encounter data is served by the worker's
+    encounter cache, which the EHR can invalidate."""
+
+    def __init__(self, user_id: int) -> None:
+        self.logger = logging.getLogger("ChatSession")
+        self.db = ConversationDB()
+        self.user_id = user_id
+        self.conversation_id: Optional[str] = None
+        self.history: List[dict] = []
+        self.max_turns = int(os.getenv("CHAT_SESSION_HISTORY_TURNS", constants.CHAT_SESSION_HISTORY_TURNS))
+        self.language = None
+        self.agent = None
+
+    async def get_agent(self, language=None):
+        """Agent of the turn, or the error message of the factory"""
+        if self.agent is None or language != self.language:
+            self.agent = await LLMAgentFactory().create(language)
+            self.language = language
+        return self.agent
+
+    async def start(self, first_input: str, convo_id: Optional[str] = None) -> str:
+        """Resume convo_id, loading its history once, or start a conversation"""
+        if self.conversation_id is not None:
+            return self.conversation_id
+        if convo_id:
+            rows = await self.db.get_conversation(convo_id)
+            for row in rows:
+                self.add_turn(row[2], row[3])  # Question and answer columns
+            self.conversation_id = str(convo_id)
+        else:
+            self.conversation_id = str(await self.db.insert_conversation(self.user_id, first_input))
+            self.logger.info(f"new Conversation ID: {self.conversation_id}")
+        return self.conversation_id
+
+    def add_turn(self, prompt: str, response: Optional[str]) -> None:
+        self.history.append({"prompt": prompt, "response": response})
+        del self.history[:-self.max_turns]
@@ -1,16 +1,58 @@
+import asyncio
 import logging
 import os
+import re
+import time
 import traceback
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List
 from fastapi import HTTPException
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
 from langchain_postgres import PGVector
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine
 import psycopg
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 import yaml
 from app.src import constants
 from langchain_openai import OpenAIEmbeddings
 from app.src.modules.auth import Authentication
+from app.src.modules.cache import get_retrieval_cache
+from app.src.modules.embeddings import CachedEmbeddings
+from app.src.modules.full_text import full_text_search, reciprocal_rank_fusion
+from app.src.modules.http_client import get_async_http_client, get_http_client
+from app.src.modules.migrations import pending_versions
+from app.src.modules.vector_index import VectorIndexManager, is_containment_filter
 
 logger = logging.getLogger("databases")
 
+# Embeddings carry the active flag of their file, see toggle_file_active
+ACTIVE_EMBEDDINGS_FILTER = {"active": True}
+
+# Indexes migration 0002 creates on langchain_pg_embedding, see embedding_index_usage
+EMBEDDING_INDEXES = (
+    "ix_cmetadata_gin",
+    "ix_langchain_pg_embedding_collection_source",
+    "ix_langchain_pg_embedding_source",
+    "ix_langchain_pg_embedding_collection_name",
+    "ix_langchain_pg_embedding_document_tsv",
+)
+
+
+def is_dimension_mismatch(err: Exception) -> bool:
+    """True for pgvector's errors on vectors of different sizes, as raised by a query
+    embedded at the size a collection had before a conversion"""
+    message = str(getattr(err, "orig", err))
+    return ("different vector dimensions" in message
+            or re.search(r"expected \d+ dimensions, not \d+", message) is not None)
+
+
 def get_connection_string():
     # conn_string = f"host='{db_host}' port='{db_port}' dbname='{
     #     db_name}' user='{db_user}' password='{db_password}' sslmode='require'"
@@ -39,6 +81,9 @@ class PGVectorManager:
         return cls.instance
 
     def __init__(self):
+        # The instance is shared, only set up the registry the first time
+        if hasattr(self, "stores"):
+            return
         self.logger = logging.getLogger("PGVectorManager")
         connection_string = get_alchemy_conn_string()
         self.connection_string = connection_string.replace(
@@ -53,76 +98,452 @@ class PGVectorManager:
                     masked_conn = f"{parts[0]}://****:****@{auth_parts[1]}"
         self.logger.debug(f"Connection string: {masked_conn}")
 
-    def return_vector_store(self, collection_name, async_mode) -> PGVector:
+        # One store per (collection_name, async_mode, dimensions), sharing the
+        # engines and the embeddings clients below
+        self.stores = {}
+        self.engine = None
+        self.async_engine = None
+        # dimensions -> embeddings client, None is the model's native size
+        self.embeddings = {}
+
+        # Leases bound how many requests use the engines at once, so a burst
+        # waits for a slot instead of timing out inside the engine pool
+        engine_args = self._engine_args()
+        self.pool_slots = engine_args["pool_size"] + engine_args["max_overflow"]
+        self.lease_slots = asyncio.Semaphore(self.pool_slots)
+        # Taken while a write lease gathers its slots, see take_lease_slots
+        self.write_slots_lock = asyncio.Lock()
+        self.active_leases = 0
+        self.leases_released = asyncio.Event()
+        self.leases_released.set()
+
+        # collection_name -> (looked up at, VectorIndex or None)
+        self.ann_indexes = {}
+        self.index_manager = None
+        # collection_name -> (looked up at, embedding dimensions)
+        self.collection_dimensions = {}
+
+    def _engine_args(self):
+        return {
+            "pool_size": int(os.getenv("VECTORSTORE_POOL_SIZE", constants.VECTORSTORE_POOL_SIZE)),
+            "max_overflow": int(os.getenv("VECTORSTORE_MAX_OVERFLOW", constants.VECTORSTORE_MAX_OVERFLOW)),
+            "pool_recycle": int(os.getenv("VECTORSTORE_POOL_RECYCLE", constants.VECTORSTORE_POOL_RECYCLE)),
+            "pool_pre_ping": True,
+        }
+
+    def _get_engine(self, async_mode):
+        if async_mode:
+            if self.async_engine is None:
+                self.async_engine = create_async_engine(
+                    self.connection_string, **self._engine_args())
+            return self.async_engine
+        if self.engine is None:
+            self.engine = create_engine(
+                self.connection_string, **self._engine_args())
+        return self.engine
+
+    def _get_embeddings(self, dimensions=None):
+        embeddings = self.embeddings.get(dimensions)
+        if embeddings is None:
+            # Reduced vectors get their own cache keys, they never mix with full size ones
+            model = constants.EMBEDDINGS_MODEL
+            embeddings = CachedEmbeddings(
+                OpenAIEmbeddings(
+                    model=model,
+                    dimensions=dimensions,
+                    http_client=get_http_client(),
+                    http_async_client=get_async_http_client(),
+                ),
+                model=model if dimensions is None else f"{model}:{dimensions}",
+                db=ConversationDB(),
+            )
+            self.embeddings[dimensions] = embeddings
+        return embeddings
+
+    def default_dimensions(self):
+        """Embedding size of new collections, EMBEDDINGS_DIMENSIONS or the model's native size"""
+        dimensions = os.getenv("EMBEDDINGS_DIMENSIONS", constants.EMBEDDINGS_DIMENSIONS)
+        return int(dimensions) if dimensions else None
+
+    async def get_collection_dimensions(self, collection_name, max_age=None):
+        """Embedding size of a collection, looked up at most every max_age seconds,
+        COLLECTION_LOOKUP_TTL by default
+
+        Collections record the size they were created or converted with in their
+        cmetadata, collections without it are stored at the model's native size.
+        """
+        ttl = max_age if max_age is not None else float(
+            os.getenv("COLLECTION_LOOKUP_TTL", constants.COLLECTION_LOOKUP_TTL))
+        cached = self.collection_dimensions.get(collection_name)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        try:
+            async with self._get_engine(True).connect() as conn:
+                result = await conn.execute(text("""
+                    SELECT cmetadata ->> 'embedding_dimensions'
+                    FROM langchain_pg_collection WHERE name = :name
+                """), {"name": collection_name})
+                row = result.first()
+        except Exception as e:
+            # The collection table only exists once the first store was created
+            self.logger.warning(f"Error looking up the dimensions of {collection_name}: {str(e)}")
+            return self.default_dimensions()
+        if row is None:
+            dimensions = self.default_dimensions()
+        else:
+            dimensions = int(row[0]) if row[0] else None
+        self.collection_dimensions[collection_name] = (time.monotonic(), dimensions)
+        return dimensions
+
+    def known_dimensions(self, collection_name):
+        """Last looked up embedding size of a collection, for the sync code paths"""
+        cached = self.collection_dimensions.get(collection_name)
+        return cached[1] if cached is not None else self.default_dimensions()
+
+    def return_vector_store(self, collection_name, async_mode, dimensions=None) -> PGVector:
+        key = (collection_name, async_mode, dimensions)
+        vectorstore = self.stores.get(key)
+        if vectorstore is not None:
+            return vectorstore
         try:
-            logger.info(f"1")
-            self.vectorstore = PGVector(
-                embeddings=OpenAIEmbeddings(model=constants.EMBEDDINGS_MODEL),
+            self.logger.info(f"Creating vector store for {key}")
+            vectorstore = PGVector(
+                embeddings=self._get_embeddings(dimensions),
                 collection_name=collection_name,
-                connection=self.connection_string,
+                collection_metadata={"embedding_dimensions": dimensions} if dimensions else None,
+                # The extension comes with the schema migrations
+                create_extension=False,
+                connection=self._get_engine(async_mode),
                 use_jsonb=True,
                 async_mode=async_mode
             )
-            logger.info(f"2")
-            return self.vectorstore
+            self.stores[key] = vectorstore
+            return vectorstore
         except Exception as e:
             self.logger.error(f"Error creating vector store: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Database connection error: {str(e)}")
 
-    async def insert_documents(self, collection_name, documents, async_mode=True):
-        try:
-            self.logger.info(f"Starting to insert {len(documents)} documents into collection {collection_name}")
-            vectorstore = self.return_vector_store(collection_name, async_mode)
-            self.logger.info("Vector store created successfully")
-            await vectorstore.aadd_documents(documents)
-            self.logger.info("Documents added successfully")
-        except Exception as e:
-            self.logger.error(f"Error inserting documents: {str(e)}")
-            self.logger.error(traceback.format_exc())
-            raise HTTPException(status_code=500, detail=f"Error inserting documents: {str(e)}")
-
     def get_retriever(self, collection_name, async_mode, search_kwargs=None):
+        """Retriever over search(), search_kwargs takes k, filter, hybrid, and ef_search /
+        probes for collections with an ANN index"""
         try:
-            vectorstore = self.return_vector_store(collection_name, async_mode)
             default_kwargs = {'k': 5}
             if search_kwargs:
                 default_kwargs.update(search_kwargs)
-            retriever = vectorstore.as_retriever(search_kwargs=default_kwargs)
+            retriever = ManagedRetriever(
+                collection_name=collection_name, search_kwargs=default_kwargs)
             return retriever
         except Exception as e:
             self.logger.error(f"Error in get_retriever: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error getting retriever: {str(e)}")
 
-    def close(self):
-        if self.vectorstore is not None:
-            if hasattr(self.vectorstore, "__async_engine"):
-                self.vectorstore.__async_engine.close()
-            if hasattr(self.vectorstore, "__engine"):
-                self.vectorstore.__engine.close()
-
-    def check_collection_exists(self, collection_name):
+    @asynccontextmanager
+    async def collection_write_lock(self, collection_name, exclusive=False):
+        """Advisory lock between the writes to a collection (shared) and
+        embedding_storage convert (exclusive), across workers and processes
+
+        Neither waits for the other: a write during a conversion, or a conversion
+        during writes, fails with a 409 instead.
+        """
+        mode = "" if exclusive else "_shared"
+        key = {"key": f"collection_write:{collection_name}"}
+        async with self._get_engine(True).connect() as conn:
+            # Session lock, it outlives the transactions of the connection
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            result = await conn.execute(text(f"SELECT pg_try_advisory_lock{mode}(hashtext(:key))"), key)
+            if not result.scalar():
+                detail = (f"Documents are being added to {collection_name}, retry the conversion once they are in"
+                          if exclusive else
+                          f"{collection_name} is being converted to another embedding size, retry once it is done")
+                raise HTTPException(status_code=409, detail=detail)
+            try:
+                yield
+            finally:
+                try:
+                    await conn.execute(text(f"SELECT pg_advisory_unlock{mode}(hashtext(:key))"), key)
+                except Exception:
+                    # Closing the session is the only other way to release the lock
+                    await conn.invalidate()
+                    raise
+
+    @asynccontextmanager
+    async def take_lease_slots(self, count):
+        """Hold count engine pool slots"""
+        async with AsyncExitStack() as stack:
+            if count == 1:
+                await stack.enter_async_context(self.lease_slots)
+            else:
+                # One lease at a time gathers several slots, so two writes holding
+                # a slot each never wait for each other's second one
+                async with self.write_slots_lock:
+                    for _ in range(count):
+                        await stack.enter_async_context(self.lease_slots)
+            yield
+
+    @asynccontextmanager
+    async def lease(self, collection_name, async_mode=True, write=False):
+        """Check a vector store out for the duration of one request
+
+        The store itself is shared and stateless between calls, the lease only
+        holds engine pool slots and keeps dispose() from tearing the engines down
+        while the request is still using them. Lookups for the request (embedding
+        size, ANN index) are made inside the lease.
+
+        Write leases hold the collection's write lock and read its embedding size
+        uncached, so documents are never embedded at the size the collection had
+        before a conversion. The lock keeps a connection of its own for the whole
+        write, so write leases hold two slots.
+        """
+        async with self.take_lease_slots(min(2, self.pool_slots) if write else 1):
+            self.active_leases += 1
+            self.leases_released.clear()
+            try:
+                async with AsyncExitStack() as stack:
+                    if write:
+                        await stack.enter_async_context(self.collection_write_lock(collection_name))
+                    dimensions = await self.get_collection_dimensions(
+                        collection_name, max_age=0 if write else None)
+                    yield self.return_vector_store(collection_name, async_mode, dimensions)
+            finally:
+                self.active_leases -= 1
+                if self.active_leases == 0:
+                    self.leases_released.set()
+
+    def get_index_manager(self):
+        if self.index_manager is None:
+            self.index_manager = VectorIndexManager(self._get_engine(True))
+        return self.index_manager
+
+    async def get_ann_index(self, collection_name):
+        """ANN index of a collection, looked up at most every VECTOR_INDEX_LOOKUP_TTL seconds"""
+        ttl = float(os.getenv("VECTOR_INDEX_LOOKUP_TTL", constants.VECTOR_INDEX_LOOKUP_TTL))
+        cached = self.ann_indexes.get(collection_name)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        try:
+            index = await self.get_index_manager().find_index(collection_name)
+        except Exception as e:
+            self.logger.error(f"Error looking up the ANN index of {collection_name}: {str(e)}")
+            index = None
+        self.ann_indexes[collection_name] = (time.monotonic(), index)
+        return index
+
+    def forget_ann_index(self, collection_name):
+        self.ann_indexes.pop(collection_name, None)
+
+    def forget_collection(self, collection_name):
+        """Drop what this worker knows about a collection after its storage changed"""
+        self.forget_ann_index(collection_name)
+        self.collection_dimensions.pop(collection_name, None)
+
+    async def search(self, collection_name, query, k=5, search_filter=None, ef_search=None, probes=None,
+                     hybrid=False):
+        """Similarity search on a leased store, served from the retrieval cache when possible
+
+        Collections with an ANN index are searched through the index, ef_search and
+        probes tune the HNSW / IVFFlat scan of that search. hybrid fuses the
+        similarity search with a full text search, see hybrid_search.
+        """
+        cache = get_retrieval_cache()
+        key = await cache.key(collection_name, query, k, search_filter, search_params={
+            "ef_search": ef_search, "probes": probes, "hybrid": hybrid or None})
+        docs = await cache.get(key)
+        if docs is not None:
+            self.logger.info(f"Retrieval cache hit for {collection_name}")
+            return docs
+        if hybrid:
+            docs = await self.hybrid_search(
+                collection_name, query, k, search_filter, ef_search=ef_search, probes=probes)
+        else:
+            docs = await self.similarity_search(
+                collection_name, query, k, search_filter, ef_search=ef_search, probes=probes)
+        await cache.set(key, docs)
+        return docs
+
+    async def similarity_search(self, collection_name, query, k, search_filter=None, ef_search=None,
+                                probes=None):
+        """Similarity search, retried once with fresh lookups if the collection was
+        converted to another embedding size since this worker looked it up
+
+        Conversions run in another process (embedding_storage convert), which can't
+        clear the cached size and ANN index of the API workers.
+        """
+        try:
+            return await self._similarity_search(
+                collection_name, query, k, search_filter, ef_search=ef_search, probes=probes)
+        except DBAPIError as e:
+            if not is_dimension_mismatch(e):
+                raise
+            self.logger.warning(f"{collection_name} changed embedding size, searching again: {str(e)}")
+            self.forget_collection(collection_name)
+            return await self._similarity_search(
+                collection_name, query, k, search_filter, ef_search=ef_search, probes=probes)
+
+    async def _similarity_search(self, collection_name, query, k, search_filter=None, ef_search=None,
+                                 probes=None):
+        async with self.lease(collection_name) as vectorstore:
+            index = await self.get_ann_index(collection_name)
+            if index is not None and is_containment_filter(search_filter):
+                embedding = await vectorstore.embeddings.aembed_query(query)
+                return await self.get_index_manager().search(
+                    index, embedding, k, search_filter, ef_search=ef_search, probes=probes)
+            return await vectorstore.asimilarity_search(query, k=k, filter=search_filter)
+
+    async def full_text_search(self, collection_name, query, k, search_filter=None):
+        """GIN indexed full text search, empty when the tsvector column isn't there yet"""
+        # Not overridable: queries must be stemmed like the stored column
+        config = constants.FULL_TEXT_SEARCH_CONFIG
+        try:
+            async with self.lease(collection_name):
+                async with self._get_engine(True).connect() as conn:
+                    return await full_text_search(
+                        conn, collection_name, query, k, config, search_filter)
+        except Exception as e:
+            self.logger.error(f"Full text search failed on {collection_name}: {str(e)}")
+            return []
+
+    async def hybrid_search(self, collection_name, query, k, search_filter=None, ef_search=None,
+                            probes=None):
+        """Run the similarity and the full text search concurrently and fuse their rankings
+
+        Exact terms (drug names, screen names) that the embeddings blur are caught
+        by the full text search.
+        """
+        if not is_containment_filter(search_filter):
+            return await self.similarity_search(
+                collection_name, query, k, search_filter, ef_search=ef_search, probes=probes)
+        fetch_k = k * int(os.getenv("HYBRID_SEARCH_FETCH_FACTOR", constants.HYBRID_SEARCH_FETCH_FACTOR))
+        rankings = await asyncio.gather(
+            self.similarity_search(collection_name, query, fetch_k, search_filter,
+                                   ef_search=ef_search, probes=probes),
+            self.full_text_search(collection_name, query, fetch_k, search_filter),
+        )
+        self.logger.info(f"Hybrid search on {collection_name}: {len(rankings[0])} similarity "
+                         f"and {len(rankings[1])} full text candidates")
+        return reciprocal_rank_fusion(rankings, k)
+
+    async def embedding_index_usage(self):
+        """Scans, size and definition of every index on langchain_pg_embedding, and how
+        often the table is still read sequentially"""
+        async with self._get_engine(True).connect() as conn:
+            result = await conn.execute(text("""
+                SELECT s.indexrelname AS index_name,
+                       s.idx_scan AS scans,
+                       s.idx_tup_read AS tuples_read,
+                       ix.indisvalid AS valid,
+                       pg_relation_size(s.indexrelid) AS size_bytes,
+                       pg_size_pretty(pg_relation_size(s.indexrelid)) AS size,
+                       pg_get_indexdef(s.indexrelid) AS definition
+                FROM pg_stat_user_indexes s
+                JOIN pg_index ix ON ix.indexrelid = s.indexrelid
+                WHERE s.relid = 'langchain_pg_embedding'::regclass
+                ORDER BY s.idx_scan DESC
+            """))
+            indexes = [dict(row._mapping) for row in result]
+            result = await conn.execute(text("""
+                SELECT seq_scan, seq_tup_read, idx_scan, n_live_tup AS live_rows,
+                       pg_size_pretty(pg_total_relation_size(relid)) AS total_size
+                FROM pg_stat_user_tables
+                WHERE relid = 'langchain_pg_embedding'::regclass
+            """))
+            table = result.first()
+        for index in indexes:
+            index["managed"] = index["index_name"] in EMBEDDING_INDEXES
+        return {
+            "table": dict(table._mapping) if table is not None else None,
+            "indexes": indexes,
+            "missing": [name for name in EMBEDDING_INDEXES
+                        if name not in {index["index_name"] for index in indexes}],
+        }
+
+    async def dispose(self, timeout=30):
+        """Wait for open leases, then drop the registered stores and dispose the shared engines"""
+        try:
+            await asyncio.wait_for(self.leases_released.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(
+                f"Disposing engines with {self.active_leases} vector store leases still open")
+        self.stores.clear()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+            self.async_engine = None
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+        self.logger.info("Vector store engines disposed")
+
+    async def check_collection_exists(self, collection_name):
         """Check if a collection exists and has data"""
         try:
-            vectorstore = self.return_vector_store(collection_name, False)
-            # Try to get one document from the collection
-            retriever = vectorstore.as_retriever(search_kwargs={'k': 1})
-            docs = retriever.invoke("test")
-            return len(docs) > 0
+            async with self._get_engine(True).connect() as conn:
+                result = await conn.execute(text("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM langchain_pg_embedding e
+                        JOIN langchain_pg_collection c ON c.uuid = e.collection_id
+                        WHERE c.name = :name
+                    )
+                """), {"name": collection_name})
+                return result.scalar()
         except Exception as e:
             self.logger.error(f"Error checking collection {collection_name}: {str(e)}")
             return False
 
-    def get_collection_stats(self, collection_name):
-        """Get statistics about a collection"""
+    async def get_collection_stats(self, collection_name, sample_size=3):
+        """Get statistics about a collection: chunk counts, sizes and last ingestion, per source"""
         try:
-            vectorstore = self.return_vector_store(collection_name, False)
-            # Get all documents from the collection
-            retriever = vectorstore.as_retriever(search_kwargs={'k': 1000})  # Get a large number to count all
-            docs = retriever.invoke("test")
+            async with self._get_engine(True).connect() as conn:
+                result = await conn.execute(text("""
+                    SELECT c.uuid,
+                           count(e.id) AS document_count,
+                           coalesce(sum(pg_column_size(e.*)), 0) AS collection_bytes,
+                           max(vector_dims(e.embedding)) AS dimensions,
+                           pg_total_relation_size('langchain_pg_embedding') AS table_bytes
+                    FROM langchain_pg_collection c
+                    LEFT JOIN langchain_pg_embedding e ON e.collection_id = c.uuid
+                    WHERE c.name = :name
+                    GROUP BY c.uuid
+                """), {"name": collection_name})
+                collection = result.first()
+                if collection is None:
+                    return {"exists": False}
+
+                # Chunks ingested before ingested_at was recorded fall back to the file upload time
+                result = await conn.execute(text("""
+                    SELECT s.source, s.chunks, s.active_chunks,
+                           coalesce(s.last_ingested_at,
+                                    (SELECT max(f.created_at)::text FROM files f
+                                     WHERE f.file_name = s.source)) AS last_ingested_at
+                    FROM (
+                        SELECT cmetadata ->> 'source' AS source,
+                               count(*) AS chunks,
+                               count(*) FILTER (WHERE cmetadata @> '{"active": true}') AS active_chunks,
+                               max(cmetadata ->> 'ingested_at') AS last_ingested_at
+                        FROM langchain_pg_embedding
+                        WHERE collection_id = :collection_id
+                        GROUP BY cmetadata ->> 'source'
+                    ) s
+                    ORDER BY s.source
+                """), {"collection_id": collection.uuid})
+                sources = [dict(row._mapping) for row in result]
+
+                result = await conn.execute(text("""
+                    SELECT left(document, 200) FROM langchain_pg_embedding
+                    WHERE collection_id = :collection_id
+                    LIMIT :sample_size
+                """), {"collection_id": collection.uuid, "sample_size": sample_size})
+                samples = [row[0] for row in result]
+
+            ingested = [source["last_ingested_at"] for source in sources if source["last_ingested_at"]]
             return {
-                "exists": True,
-                "document_count": len(docs),
-                "sample_documents": [doc.page_content[:200] for doc in docs[:3]]  # First 200 chars of first 3 docs
+                "exists": collection.document_count > 0,
+                "document_count": collection.document_count,
+                "source_count": len(sources),
+                "dimensions": collection.dimensions,
+                "collection_bytes": collection.collection_bytes,
+                "table_bytes": collection.table_bytes,
+                "last_ingested_at": max(ingested) if ingested else None,
+                "sources": sources,
+                "sample_documents": samples,
             }
         except Exception as e:
             self.logger.error(f"Error getting stats for collection {collection_name}: {str(e)}")
@@ -131,6 +552,18 @@ class PGVectorManager:
                 "error": str(e)
             }
 
+    async def list_collections(self):
+        """Every collection with its chunk count"""
+        async with self._get_engine(True).connect() as conn:
+            result = await conn.execute(text("""
+                SELECT c.name, count(e.id) AS document_count
+                FROM langchain_pg_collection c
+                LEFT JOIN langchain_pg_embedding e ON e.collection_id = c.uuid
+                GROUP BY c.name
+                ORDER BY c.name
+            """))
+            return [dict(row._mapping) for row in result]
+
 
 class ConversationDB:
     def __new__(cls):
@@ -139,143 +572,54 @@ class ConversationDB:
         return cls.instance
 
     def __init__(self):
+        # The instance is shared, only build the pool the first time
+        if hasattr(self, "pool"):
+            return
         self.logger = logging.getLogger("CoversationDB")
-        try:
-            self.logger.info(
-                "Creating connection string for conversation db")
-
-            conn_string = get_connection_string()
-            self.logger.info(f"Connection string: {conn_string}")
-
-            if conn_string is None:
-                raise AttributeError(
-                    'No connection string provided for conversation db')
-            self.conn_string = conn_string
-            print(conn_string)
-            print("AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
-            conn = psycopg.connect(conn_string)
-            cursor = conn.cursor()
-            # uncomment if you want to create the table again
-            # cursor.execute('DROP TABLE IF EXISTS queries')
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS queries (
-            id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-            Convo_ID TEXT,
-            Question TEXT,
-            Answer TEXT,
-            Prompt TEXT,
-            timestamp timestamp default current_timestamp,
-            response_time double precision, 
-            rating integer, 
-            review text,
-            user_id TEXT
-            )
-                ''')
+        self.logger.info(
+            "Creating connection pool for conversation db")
+
+        conn_string = get_connection_string()
+
+        if conn_string is None:
+            raise AttributeError(
+                'No connection string provided for conversation db')
+        self.conn_string = conn_string
+        self.pool = AsyncConnectionPool(
+            conninfo=conn_string,
+            min_size=int(os.getenv("PG_POOL_MIN_SIZE", constants.PG_POOL_MIN_SIZE)),
+            max_size=int(os.getenv("PG_POOL_MAX_SIZE", constants.PG_POOL_MAX_SIZE)),
+            max_idle=float(os.getenv("PG_POOL_MAX_IDLE", constants.PG_POOL_MAX_IDLE)),
+            timeout=float(os.getenv("PG_POOL_TIMEOUT", constants.PG_POOL_TIMEOUT)),
+            check=AsyncConnectionPool.check_connection,
+            name="conversation-db",
+            open=False,
+        )
 
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS Users (
-            id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-            name TEXT,
-            email TEXT,
-            designation TEXT,
-            department TEXT,
-            role TEXT,
-            firebase_uid TEXT,
-            created_at timestamp default current_timestamp, 
-            updated_at timestamp default current_timestamp,
-            last_login timestamp,
-            last_session_duration double precision
-            )
-            ''')
-
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS AllowedEmails (
-            id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-            name TEXT,
-            email TEXT,
-            role TEXT,
-            allowed_by TEXT not null,
-            created_at timestamp default current_timestamp, 
-            updated_at timestamp default current_timestamp
-            )
-            ''')
-
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS AllowedDomains (
-            id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-            domain_name Text,
-            allowed_by TEXT not null,
-            created_at timestamp default current_timestamp, 
-            updated_at timestamp default current_timestamp
-            )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS conversation (
-                    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-                    user_id text not null,
-                    first_question Text,
-                    description TEXT,
-                    created_at timestamp default current_timestamp                           
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS docProcTemplates (
-                    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-                    user_id text not null,
-                    template_name Text,
-                    attributes TEXT,
-                    created_at timestamp default current_timestamp                           
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS allowedips (
-                    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-                    ip_address TEXT,
-                    created_at timestamp default current_timestamp,
-                    updated_at timestamp default current_timestamp
-                           )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS parentdocuments (
-                    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-                    parent_document TEXT,
-                    created_at timestamp default current_timestamp
-                )
-                           ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS prompts (
-                    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-                    llm_model TEXT,
-                    persona TEXT,
-                    glossary TEXT,
-                    tone TEXT,
-                    response_length TEXT,
-                    content TEXT,
-                    created_at timestamp DEFAULT current_timestamp,
-                    updated_at timestamp DEFAULT current_timestamp
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS files (
-                    id uuid DEFAULT gen_random_uuid() PRIMARY KEY,
-                    file_name text NOT NULL,
-                    url text NOT NULL,
-                    user_id text NOT NULL,
-                    created_at timestamp DEFAULT current_timestamp,
-                    updated_at timestamp DEFAULT current_timestamp,
-                    active boolean DEFAULT true
-                );
-                ''')
+    async def open(self):
+        """Open the connection pool without waiting for its connections, and check the
+        schema migrations in the background"""
+        await self.pool.open(wait=False)
+        self.logger.info("Connection pool opened")
+        # Keep a reference, the event loop only holds tasks weakly
+        self.migrations_check = asyncio.create_task(self.check_migrations())
 
-            conn.commit()
-            cursor.close()
-            conn.close()
-        except psycopg.Error as err:
+    async def check_migrations(self):
+        try:
+            async with self.pool.connection() as conn:
+                pending = await pending_versions(conn)
+            if pending:
+                self.logger.warning(
+                    f"Schema migrations {pending} are not applied, "
+                    "run python -m app.src.modules.migrations migrate")
+        except (psycopg.Error, PoolTimeout) as err:
             self.logger.exception(err)
 
+    async def close(self):
+        """Close the connection pool"""
+        await self.pool.close()
+        self.logger.info("Connection pool closed")
+
     async def add_files(self, data, user_id):
         try:
             # Prepare data for batch insertion
@@ -285,201 +629,234 @@ class ConversationDB:
                       for item in data]
             self.logger.info(f"Prepared values for insertion: {values}")
 
-            conn = psycopg.connect(self.conn_string)
-            cursor = conn.cursor()
-            cursor.executemany('''
-                INSERT INTO files (file_name, url, user_id)
-                VALUES (%s, %s, %s)
-            ''', values)
-            conn.commit()
-            cursor.close()
-            conn.close()
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    # A file uploaded again keeps the active flag it was given
+                    await cursor.executemany('''
+                        INSERT INTO files (file_name, url, user_id, active)
+                        VALUES (%s, %s, %s, COALESCE(
+                            (SELECT bool_and(active) FROM public.files WHERE file_name = %s), true))
+                    ''', [(*value, value[0]) for value in values])
             self.logger.info("Successfully inserted files into database")
 
         except psycopg.Error as err:
             self.logger.exception(err)
 
     async def get_files(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT file_name, url, user_id, created_at, updated_at, active
-            FROM public.files 
-            order by created_at desc
-        ''',)
-
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT file_name, url, user_id, created_at, updated_at, active
+                    FROM public.files 
+                    order by created_at desc
+                ''',)
+                rows = await cursor.fetchall()
         return rows
 
     async def get_active_files(self):
-
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT q.file_name
-            FROM public.files q 
-            where q.active = true
-            ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT q.file_name
+                    FROM public.files q 
+                    where q.active = true
+                    ''')
+                rows = await cursor.fetchall()
         return rows
 
+    async def get_file_active(self, file_name):
+        """Active flag of an uploaded file, True for a file that is not uploaded yet"""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute('''
+                SELECT bool_and(active) FROM public.files WHERE file_name = %s
+            ''', (file_name,))
+            row = await cursor.fetchone()
+        return row[0] if row[0] is not None else True
+
     async def delete_file(self, file_name):
         try:
-            self.conn = psycopg.connect(self.conn_string)
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                Delete
-                FROM public.files 
-                where file_name=%s;
-                ''', (file_name,))
-            # rows = cursor.fetchall(
-            self.conn.commit()
-            cursor.close()
-            self.conn.close()
+            async with self.pool.connection() as conn:
+                await conn.execute('''
+                    Delete
+                    FROM public.files 
+                    where file_name=%s;
+                    ''', (file_name,))
+            return "Deleted"
+        except psycopg.Error as err:
+            self.logger.exception(err)
+
+    async def delete_files(self, file_names):
+        try:
+            async with self.pool.connection() as conn:
+                await conn.execute('''
+                    DELETE FROM public.files
+                    WHERE file_name = ANY(%s);
+                    ''', (list(file_names),))
             return "Deleted"
         except psycopg.Error as err:
             self.logger.exception(err)
 
     async def toggle_file_active(self, file_name, active_flag):
         try:
-            self.conn = psycopg.connect(self.conn_string)
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                UPDATE public.files
-                SET active = %s
-                WHERE file_name = %s;
-            ''', (active_flag, file_name))
-            # rows = cursor.fetchall(
-            self.conn.commit()
-            cursor.close()
-            self.conn.close()
+            async with self.pool.connection() as conn:
+                await conn.execute('''
+                    UPDATE public.files
+                    SET active = %s
+                    WHERE file_name = %s;
+                ''', (active_flag, file_name))
+                # Same transaction, searches filter on the embeddings' copy of the flag
+                await conn.execute('''
+                    UPDATE public.langchain_pg_embedding
+                    SET cmetadata = jsonb_set(cmetadata, '{active}', to_jsonb(%s::boolean))
+                    WHERE cmetadata ->> 'source' = %s;
+                ''', (active_flag, file_name))
+            await get_retrieval_cache().bump_epoch()
             return "Updated"
         except psycopg.Error as err:
             self.logger.exception(err)
 
-    async def delete_file_embeddings(self, file_name):
+    async def delete_file_embeddings(self, file_name, collection_name=None):
+        return await self.delete_files_embeddings([file_name], collection_name)
+
+    async def delete_files_embeddings(self, file_names, collection_name=None):
+        """Delete the embeddings of the given source files in one statement, in every
+        collection or only in collection_name. Sources are matched exactly, which
+        the source expression indexes serve."""
         try:
-            self.conn = psycopg.connect(self.conn_string)
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                DELETE FROM public.langchain_pg_embedding
-                WHERE cmetadata ->> 'source' LIKE %s;
-            ''', ('%' + file_name + '%',))
-
-            self.conn.commit()
-            cursor.close()
-            self.conn.close()
+            async with self.pool.connection() as conn:
+                if collection_name is None:
+                    cursor = await conn.execute('''
+                        DELETE FROM public.langchain_pg_embedding
+                        WHERE cmetadata ->> 'source' = ANY(%s);
+                    ''', (list(file_names),))
+                else:
+                    cursor = await conn.execute('''
+                        DELETE FROM public.langchain_pg_embedding
+                        WHERE collection_id = (
+                            SELECT uuid FROM public.langchain_pg_collection WHERE name = %s
+                        )
+                        AND cmetadata ->> 'source' = ANY(%s);
+                    ''', (collection_name, list(file_names)))
+                self.logger.info(f"Deleted {cursor.rowcount} embeddings of {len(file_names)} files")
+            await get_retrieval_cache().bump_epoch(collection_name)
             return "Deleted Embeddings"
         except psycopg.Error as err:
             self.logger.exception(err)
 
+    async def get_cached_embeddings(self, content_hashes):
+        """Return {content_hash: embedding} for the hashes found in the embedding cache"""
+        if not content_hashes:
+            return {}
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT content_hash, embedding
+                    FROM embedding_cache
+                    WHERE content_hash = ANY(%s)
+                ''', (content_hashes,))
+                rows = await cursor.fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    async def insert_cached_embeddings(self, model, embeddings):
+        """Store {content_hash: embedding} computed with the given model"""
+        values = [(content_hash, model, embedding)
+                  for content_hash, embedding in embeddings.items()]
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany('''
+                    INSERT INTO embedding_cache (content_hash, model, embedding)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (content_hash) DO NOTHING
+                ''', values)
+
     async def insert_query(self, conversation_id, query, response, prompt, response_time, user_id):
         try:
             self.logger.info(f"Inserting query: {query} into conversation: {conversation_id}")
-            conn = psycopg.connect(self.conn_string)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO queries (convo_ID, Question, Answer, Prompt, response_time, user_id)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id;
-            ''', (conversation_id, query, response, prompt, response_time, user_id))
-            id = cursor.fetchall()
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute('''
+                        INSERT INTO queries (convo_ID, Question, Answer, Prompt, response_time, user_id)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        RETURNING id;
+                    ''', (conversation_id, query, response, prompt, response_time, user_id))
+                    id = await cursor.fetchall()
             query_id = id[0][0]
-            conn.commit()
-            cursor.close()
-            conn.close()
 
             return query_id
         except psycopg.Error as err:
             self.logger.exception(err)
 
-    def insert_hr_query(self, conversation_id, query, response, context, response_time, user_id):
+    async def insert_hr_query(self, conversation_id, query, response, context, response_time, user_id):
         self.logger.info(
             f"Inserting query: {query} into conversation: {conversation_id}"
         )
-        conn = psycopg.connect(self.conn_string)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO hr_questions (convo_ID, Question, Answer, context, response_time, user_id)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id;
-        ''', (conversation_id, query, response, context, response_time, user_id))
-        id = cursor.fetchall()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    INSERT INTO hr_questions (convo_ID, Question, Answer, context, response_time, user_id)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING id;
+                ''', (conversation_id, query, response, context, response_time, user_id))
+                id = await cursor.fetchall()
         query_id = id[0][0]
-        conn.commit()
-        cursor.close()
-        conn.close()
 
         return query_id
 
     async def insert_prompt(self, prompt):
         self.logger.info(f"Inserting query: {prompt} into prompts:")
-        conn = psycopg.connect(self.conn_string)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO prompts (llm_model, persona, glossary, tone, response_length ,content)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id;
-        ''', (prompt.llm_model, prompt.persona, prompt.glossary, prompt.tone, prompt.response_length, prompt.content,))
-        id = cursor.fetchall()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    INSERT INTO prompts (llm_model, persona, glossary, tone, response_length ,content)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING id;
+                ''', (prompt.llm_model, prompt.persona, prompt.glossary, prompt.tone, prompt.response_length, prompt.content,))
+                id = await cursor.fetchall()
         query_id = id[0][0]
-        conn.commit()
-        cursor.close()
-        conn.close()
 
         return query_id
 
     async def get_prompt(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT llm_model, persona, glossary, tone, response_length ,content FROM prompts
-            ORDER BY created_at DESC
-            LIMIT 1;
-        ''')
-        row = cursor.fetchone()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT llm_model, persona, glossary, tone, response_length ,content FROM prompts
+                    ORDER BY created_at DESC
+                    LIMIT 1;
+                ''')
+                row = await cursor.fetchone()
         return row
 
-    def get_rows(self, num_months, number_of_rows=10):
+    async def get_rows(self, num_months, number_of_rows=10):
         try:
-            conn = psycopg.connect(self.conn_string)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT *
-                FROM queries
-                WHERE timestamp >= CURRENT_DATE - INTERVAL '%s month'
-                AND timestamp < CURRENT_DATE
-                ORDER BY timestamp DESC
-                LIMIT %s;
-            ''', (num_months, number_of_rows))
-            rows = cursor.fetchall()
-            cursor.close()
-            conn.close()
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute('''
+                        SELECT *
+                        FROM queries
+                        WHERE timestamp >= CURRENT_DATE - INTERVAL '%s month'
+                        AND timestamp < CURRENT_DATE
+                        ORDER BY timestamp DESC
+                        LIMIT %s;
+                    ''', (num_months, number_of_rows))
+                    rows = await cursor.fetchall()
             return rows
         except psycopg.Error as err:
             self.logger.exception(err)
             return None
 
-    def get_daily_usage_rows(self):
+    async def get_daily_usage_rows(self):
         try:
-            conn = psycopg.connect(self.conn_string)
-            cursor = conn.cursor()
-            query = """
-             SELECT timestamp
-             FROM queries
-             WHERE timestamp >= CURRENT_DATE - INTERVAL '1 month'
-             AND timestamp < CURRENT_DATE;
-             """
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            cursor.close()
-            conn.close()
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    query = """
+                     SELECT timestamp
+                     FROM queries
+                     WHERE timestamp >= CURRENT_DATE - INTERVAL '1 month'
+                     AND timestamp < CURRENT_DATE;
+                     """
+                    await cursor.execute(query)
+                    rows = await cursor.fetchall()
             return rows
         except psycopg.Error as err:
             self.logger.exception(err)
@@ -487,24 +864,18 @@ class ConversationDB:
 
     async def insert_review_and_rating(self, query_id, rating, review):
         try:
-            conn = psycopg.connect(self.conn_string)
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE queries
-                SET rating = %s,
-                    review = %s
-                WHERE id = %s;
-            ''', (rating, review, query_id))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            async with self.pool.connection() as conn:
+                await conn.execute('''
+                    UPDATE queries
+                    SET rating = %s,
+                        review = %s
+                    WHERE id = %s;
+                ''', (rating, review, query_id))
         except psycopg.Error as err:
             self.logger.exception(err)
 
     async def insert_hr_review_and_rating(self, query_id, rating, review):
         try:
-            conn = psycopg.connect(self.conn_string)
-            cursor = conn.cursor()
             query = """
                 UPDATE hr_questions SET
                 """
@@ -525,268 +896,229 @@ class ConversationDB:
 
             query += " WHERE id = %s;"
 
-            cursor.execute(query, inputs)
-
-            conn.commit()
-            cursor.close()
-            conn.close()
+            async with self.pool.connection() as conn:
+                await conn.execute(query, inputs)
         except psycopg.Error as err:
             self.logger.exception(err)
 
     async def insert_google_user(self, name, email, uid, role):
-        conn = psycopg.connect(self.conn_string)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO Users (name, email, firebase_uid, role)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id;
-        ''', (name, email, uid, role))
-        localid = cursor.fetchall()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    INSERT INTO Users (name, email, firebase_uid, role)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING id;
+                ''', (name, email, uid, role))
+                localid = await cursor.fetchall()
         user_id = localid[0][0]
-        conn.commit()
-        cursor.close()
-        conn.close()
         return user_id
 
     async def insert_conversation(self, user_id, first_question):
-        conn = psycopg.connect(self.conn_string)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO conversation (user_id, first_question)
-            VALUES (%s, %s)
-            RETURNING id;
-        ''', (user_id, first_question))
-        conversation_id = cursor.fetchall()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    INSERT INTO conversation (user_id, first_question)
+                    VALUES (%s, %s)
+                    RETURNING id;
+                ''', (user_id, first_question))
+                conversation_id = await cursor.fetchall()
         conversation_id = conversation_id[0][0]
-        conn.commit()
-        cursor.close()
-        conn.close()
         return conversation_id
 
     async def update_user(self, id, column, value):
-        conn = psycopg.connect(self.conn_string)
-        cursor = conn.cursor()
-        cursor.execute(f'''
-            UPDATE Users
-            SET {column} = %s
-            WHERE id = %s
-        ''', (value, id))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        async with self.pool.connection() as conn:
+            await conn.execute(f'''
+                UPDATE Users
+                SET {column} = %s
+                WHERE id = %s
+            ''', (value, id))
 
     async def does_user_exist(self, email):
-        conn = psycopg.connect(self.conn_string)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM Users
-            WHERE email = %s
-        ''', (email,))
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT *
+                    FROM Users
+                    WHERE email = %s
+                ''', (email,))
+                rows = await cursor.fetchall()
         if len(rows) > 0:
             return True, rows[0]
         return False, None
 
     async def change_user_role(self, role, email):
         try:
-            conn = psycopg.connect(self.conn_string)
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE Users
-                SET role = %s, updated_at = current_timestamp
-                WHERE email = %s
-            ''', (role, email))
-
-            cursor.execute(
-                """
-                UPDATE allowedemails
-                SET role = %s, updated_at = current_timestamp
-                WHERE email = %s
-                """,
-                (role, email)
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute('''
+                        UPDATE Users
+                        SET role = %s, updated_at = current_timestamp
+                        WHERE email = %s
+                    ''', (role, email))
+
+                    await cursor.execute(
+                        """
+                        UPDATE allowedemails
+                        SET role = %s, updated_at = current_timestamp
+                        WHERE email = %s
+                        """,
+                        (role, email)
+                    )
             return True
         except psycopg.Error as err:
             self.logger.exception(err)
             return False
 
     async def insert_user(self, name, email, password, designation=None, department=None, role=constants.DEFAULT_ROLE):
+        user_id = None
+        self.auth = Authentication()
         try:
-            self.conn = psycopg.connect(self.conn_string)
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO Users (name, email, designation, department, role)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id;
-            ''', (name, email, designation, department, role))
-            user_id = cursor.fetchall()
-            user_id = str(user_id[0][0])
-            self.auth = Authentication()
-            user = None
-            if user_id is not None:
-                user = await self.auth.signup(id=user_id, email=email, name=name, password=password, role=role)
-
-            if user is None:
-                raise RuntimeError("Firebase User not created")
-
-            loggedin_user = await self.auth.sign_in_with_email_and_password(email=user.email, password=password)
-            print(loggedin_user)
-
-            # res = await self.auth.send_email_verification(loggedin_user["idToken"])
-
-            res = await self.auth.update_user({"uid": user_id, "emailVerified": True})
-
-            self.logger.info(res)
-
-            # await self.auth.sign_out_user(user_id)
-            self.conn.commit()
-            cursor.close()
-            self.conn.close()
+            # The transaction is only committed once the firebase user exists,
+            # any exception raised inside the block rolls the insert back
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute('''
+                        INSERT INTO Users (name, email, designation, department, role)
+                        VALUES (%s, %s, %s, %s, %s)
+                        RETURNING id;
+                    ''', (name, email, designation, department, role))
+                    user_id = await cursor.fetchall()
+                    user_id = str(user_id[0][0])
+                    user = None
+                    if user_id is not None:
+                        user = await self.auth.signup(id=user_id, email=email, name=name, password=password, role=role)
+
+                    if user is None:
+                        raise RuntimeError("Firebase User not created")
+
+                    loggedin_user = await self.auth.sign_in_with_email_and_password(email=user.email, password=password)
+                    print(loggedin_user)
+
+                    # res = await self.auth.send_email_verification(loggedin_user["idToken"])
+
+                    res = await self.auth.update_user({"uid": user_id, "emailVerified": True})
+
+                    self.logger.info(res)
+
+                    # await self.auth.sign_out_user(user_id)
             return user
         except Exception:
             self.logger.info(
                 "There has been an error in creating a user, rolling back and reversing all changes")
             self.logger.exception(traceback.format_exc())
-            await self.auth.delete_user(user_id)
-            self.conn.rollback()
-            self.conn.close()
+            if user_id is not None:
+                await self.auth.delete_user(user_id)
             raise HTTPException(
                 status_code=500, detail="Failed to create user")
 
     async def allowed_email_addresses(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM allowedemails
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT *
+                    FROM allowedemails
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def select_all_from_allowed_email_addresses(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM allowedemails
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT *
+                    FROM allowedemails
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def allowed_email_domains(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT domain_name
-            FROM alloweddomains
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT domain_name
+                    FROM alloweddomains
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def get_conversation(self, convo_id):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM queries
-            WHERE convo_id = %s
-        ''', (convo_id,))
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT *
+                    FROM queries
+                    WHERE convo_id = %s
+                ''', (convo_id,))
+                rows = await cursor.fetchall()
         return rows
 
     async def get_hr_conversation(self, convo_id):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM hr_questions
-            WHERE convo_id = %s
-        ''', (convo_id,))
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT *
+                    FROM hr_questions
+                    WHERE convo_id = %s
+                ''', (convo_id,))
+                rows = await cursor.fetchall()
         return rows
 
     async def get_conversation_ids(self, user_id):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT id, first_question
-            FROM conversation
-            WHERE user_id = %s
-        ''', (user_id,))
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT id, first_question
+                    FROM conversation
+                    WHERE user_id = %s
+                ''', (user_id,))
+                rows = await cursor.fetchall()
         return rows
 
     async def get_user_by_email(self, email):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM Users
-            WHERE email = %s
-        ''', (email,))
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT *
+                    FROM Users
+                    WHERE email = %s
+                ''', (email,))
+                rows = await cursor.fetchall()
         return rows
 
     async def get_ask_engr_queries(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT u.name, u.email, q.question, q.answer, q.review, q.rating, q.timestamp, q.response_time
-            FROM public.queries q join users u on q.user_id=u.id::text
-            ORDER BY timestamp desc
-            LIMIT 100;
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT u.name, u.email, q.question, q.answer, q.review, q.rating, q.timestamp, q.response_time
+                    FROM public.queries q join users u on q.user_id=u.id::text
+                    ORDER BY timestamp desc
+                    LIMIT 100;
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def get_ask_hr_queries(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT u.name, u.email, q.question, q.answer, q.review, q.rating, q.created_at, q.response_time
-            FROM public.hr_questions q join users u on q.user_id=u.id::text
-            ORDER BY created_at desc
-            LIMIT 100;
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT u.name, u.email, q.question, q.answer, q.review, q.rating, q.created_at, q.response_time
+                    FROM public.hr_questions q join users u on q.user_id=u.id::text
+                    ORDER BY created_at desc
+                    LIMIT 100;
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def get_ask_engr_response_time(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT response_time
-            FROM public.queries
-            ORDER BY timestamp desc
-            LIMIT 100;
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT response_time
+                    FROM public.queries
+                    ORDER BY timestamp desc
+                    LIMIT 100;
+                ''')
+                rows = await cursor.fetchall()
         float_values = [tup[0] for tup in rows]
         average = sum(float_values) / len(float_values)
         res = {}
@@ -795,17 +1127,15 @@ class ConversationDB:
         return res
 
     async def get_ask_hr_response_time(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT response_time
-            FROM public.hr_questions
-            ORDER BY created_at desc
-            LIMIT 100;
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT response_time
+                    FROM public.hr_questions
+                    ORDER BY created_at desc
+                    LIMIT 100;
+                ''')
+                rows = await cursor.fetchall()
         float_values = [tup[0] for tup in rows]
         average = sum(float_values) / len(float_values)
         res = {}
@@ -814,116 +1144,126 @@ class ConversationDB:
         return res
 
     async def get_ask_engr_daily_usage(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT DATE_TRUNC('day', timestamp) AS usage_date, COUNT(*) AS total_usage
-            FROM public.queries
-            WHERE timestamp >= CURRENT_DATE - INTERVAL '1 month' AND timestamp < CURRENT_DATE + INTERVAL '1 day'
-            GROUP BY usage_date
-            ORDER BY usage_date;
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT DATE_TRUNC('day', timestamp) AS usage_date, COUNT(*) AS total_usage
+                    FROM public.queries
+                    WHERE timestamp >= CURRENT_DATE - INTERVAL '1 month' AND timestamp < CURRENT_DATE + INTERVAL '1 day'
+                    GROUP BY usage_date
+                    ORDER BY usage_date;
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def get_ask_hr_daily_usage(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT DATE_TRUNC('day', created_at) AS usage_date, COUNT(*) AS total_usage
-            FROM public.hr_questions
-            WHERE created_at >= CURRENT_DATE - INTERVAL '1 month' AND created_at < CURRENT_DATE + INTERVAL '1 day'
-            GROUP BY usage_date
-            ORDER BY usage_date ASC;
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT DATE_TRUNC('day', created_at) AS usage_date, COUNT(*) AS total_usage
+                    FROM public.hr_questions
+                    WHERE created_at >= CURRENT_DATE - INTERVAL '1 month' AND created_at < CURRENT_DATE + INTERVAL '1 day'
+                    GROUP BY usage_date
+                    ORDER BY usage_date ASC;
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def save_template(self, user_id, template_name, attributes):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO docproctemplates (user_id, template_name, attributes)
-            VALUES (%s, %s, %s)
-            RETURNING id;
-        ''', (user_id, template_name, attributes))
-        self.conn.commit()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            await conn.execute('''
+                INSERT INTO docproctemplates (user_id, template_name, attributes)
+                VALUES (%s, %s, %s)
+                RETURNING id;
+            ''', (user_id, template_name, attributes))
         return True
 
     async def get_user_templates(self, user_id):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT template_name, attributes
-            FROM docproctemplates
-            WHERE user_id = %s
-        ''', (user_id,))
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT template_name, attributes
+                    FROM docproctemplates
+                    WHERE user_id = %s
+                ''', (user_id,))
+                rows = await cursor.fetchall()
         return rows
 
     async def get_users(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT name, email, role, created_at, last_login, last_session_duration
-            FROM users
-            ORDER BY last_login desc
-            NULLS last
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT name, email, role, created_at, last_login, last_session_duration
+                    FROM users
+                    ORDER BY last_login desc
+                    NULLS last
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def update_user(self, email, column, value):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute(f'''
-            UPDATE users
-            SET {column} = %s
-            WHERE email = %s
-        ''', (value, email))
-        self.conn.commit()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            await conn.execute(f'''
+                UPDATE users
+                SET {column} = %s
+                WHERE email = %s
+            ''', (value, email))
         return True
 
     async def get_allowed_ips(self):
-        self.conn = psycopg.connect(self.conn_string)
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT ip_address
-            FROM allowedips
-        ''')
-        rows = cursor.fetchall()
-        cursor.close()
-        self.conn.close()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('''
+                    SELECT ip_address
+                    FROM allowedips
+                ''')
+                rows = await cursor.fetchall()
         return rows
 
     async def get_file_names_by_collection(self, collection_name: str):
         """Get all file names associated with a specific collection from the langchain_pg_embedding table."""
         try:
-            self.conn = psycopg.connect(self.conn_string)
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT DISTINCT cmetadata ->> 'source' as file_name
-                FROM public.langchain_pg_embedding
-                WHERE cmetadata ->> 'collection_name' = %s
-            ''', (collection_name,))
-            rows = cursor.fetchall()
-            cursor.close()
-            self.conn.close()
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute('''
+                        SELECT DISTINCT cmetadata ->> 'source' as file_name
+                        FROM public.langchain_pg_embedding
+                        WHERE cmetadata ->> 'collection_name' = %s
+                    ''', (collection_name,))
+                    rows = await cursor.fetchall()
             # Extract file names from the results and remove any None values
             file_names = [row[0] for row in rows if row[0] is not None]
             return file_names
         except psycopg.Error as err:
             self.logger.exception(err)
             raise err
+
+
+class ManagedRetriever(BaseRetriever):
+    """Retriever backed by PGVectorManager.search, so it goes through the retrieval
+    cache and the collection's ANN index"""
+
+    collection_name: str
+    search_kwargs: dict = {}
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # The cache and the index search are async only, sync callers get a plain search
+        pgmanager = PGVectorManager()
+        vectorstore = pgmanager.return_vector_store(
+            self.collection_name, False, pgmanager.known_dimensions(self.collection_name))
+        return vectorstore.similarity_search(
+            query, k=self.search_kwargs.get("k", 5), filter=self.search_kwargs.get("filter"))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        kwargs = dict(self.search_kwargs)
+        return await PGVectorManager().search(
+            self.collection_name,
+            query,
+            k=kwargs.pop("k", 5),
+            search_filter=kwargs.pop("filter", None),
+            **kwargs,
+        )
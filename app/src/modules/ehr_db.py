@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import List, NamedTuple, Optional
+
+import aiomysql
+
+from app.src import constants
+from app.src.modules import startup
+
+# Only the columns the treatment plan uses, see filter_patient_data
+PATIENT_QUERY = "SELECT id, firstName, sexAtBirthCode FROM patients WHERE id = %s"
+ALLERGIES_QUERY = "SELECT allergy, allergytype, severitiesCode FROM allergies WHERE patientId = %s"
+PROBLEMS_QUERY = "SELECT problemorissue FROM problem WHERE patient_id = %s"
+MEDICATIONS_QUERY = """
+    SELECT drugname, quantity, dose, reason, instruction
+    FROM patient_medications WHERE patient_id = %s
+"""
+VITALS_QUERY = """
+    SELECT heightFt, heightIn, weightKilo, weightGram, weightUnit, bmi, pulseBpm,
+           systolicBloodPressure, diastolicBloodPressure, recordDate
+    FROM vitals WHERE patientId = %s
+"""
+
+
+class PatientRecord(NamedTuple):
+    """Rows of a patient's record needed by the treatment plan"""
+    patient: Optional[dict]
+    allergies: List[dict]
+    problems: List[dict]
+    medications: List[dict]
+    vitals: List[dict]
+
+
+class EHRDatabase:
+    """Async connection pool to the EHR MySQL database (patients, encounters, vitals...)
+
+    The pool is created on first use so the API starts without MySQL. Each
+    request checks a connection out for its own queries, and connections are
+    pinged before use so a connection dropped by the server is replaced
+    instead of failing the request.
+    """
+
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super(EHRDatabase, cls).__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        # The instance is shared, only set it up the first time
+        if hasattr(self, "pool"):
+            return
+        self.logger = logging.getLogger("EHRDatabase")
+        self.pool = None
+        self.pool_lock = asyncio.Lock()
+
+    async def get_pool(self):
+        if self.pool is not None:
+            return self.pool
+        async with self.pool_lock:
+            if self.pool is None:
+                with startup.timed("mysql pool"):
+                    self.pool = await aiomysql.create_pool(
+                        host=os.environ.get("MYSQL_HOST"),
+                        port=int(os.getenv("MYSQL_PORT", 3306)),
+                        user=os.environ.get("MYSQL_USERNAME"),
+                        password=os.environ.get("MYSQL_PASSWORD"),
+                        db=os.environ.get("MYSQL_DATABASE"),
+                        minsize=int(os.getenv("MYSQL_POOL_MIN_SIZE", constants.MYSQL_POOL_MIN_SIZE)),
+                        maxsize=int(os.getenv("MYSQL_POOL_MAX_SIZE", constants.MYSQL_POOL_MAX_SIZE)),
+                        pool_recycle=int(os.getenv("MYSQL_POOL_RECYCLE", constants.MYSQL_POOL_RECYCLE)),
+                        connect_timeout=int(os.getenv("MYSQL_CONNECT_TIMEOUT", constants.MYSQL_CONNECT_TIMEOUT)),
+                        # Reads only, and a pooled connection must not keep an old snapshot
+                        autocommit=True,
+                    )
+                self.logger.info(f"MySQL pool created, {self.pool.size} connections")
+        return self.pool
+
+    @asynccontextmanager
+    async def connection(self):
+        """Check a healthy connection out of the pool for the duration of a request"""
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            await conn.ping(reconnect=True)
+            yield conn
+
+    @asynccontextmanager
+    async def cursor(self):
+        """Dict cursor on a checked out connection, for requests running several queries"""
+        async with self.connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                yield cursor
+
+    async def fetchone(self, query, params=None):
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            return await cursor.fetchone()
+
+    async def fetchall(self, query, params=None):
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            return await cursor.fetchall()
+
+    async def load_patient_record(self, patient_id) -> PatientRecord:
+        """Run the record queries concurrently, each on its own pooled connection"""
+        patient, allergies, problems, medications, vitals = await asyncio.gather(
+            self.fetchone(PATIENT_QUERY, (patient_id,)),
+            self.fetchall(ALLERGIES_QUERY, (patient_id,)),
+            self.fetchall(PROBLEMS_QUERY, (patient_id,)),
+            self.fetchall(MEDICATIONS_QUERY, (patient_id,)),
+            self.fetchall(VITALS_QUERY, (patient_id,)),
+        )
+        return PatientRecord(patient, list(allergies), list(problems), list(medications), list(vitals))
+
+    async def close(self):
+        if self.pool is None:
+            return
+        self.pool.close()
+        await self.pool.wait_closed()
+        self.pool = None
+        self.logger.info("MySQL pool closed")
@@ -0,0 +1,283 @@
+"""Convert collections to reduced dimension embeddings, and benchmark the storage modes.
+
+text-embedding-3 models are trained so that the first n dimensions of a vector,
+normalized again, are an embedding of size n, which is what the API returns for
+dimensions=n. Collections can therefore be shrunk in SQL without calling the API.
+
+    python -m app.src.modules.embedding_storage benchmark COLLECTION --dimensions 1024 1536
+    python -m app.src.modules.embedding_storage convert COLLECTION --dimensions 1024
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import statistics
+import sys
+import time
+from typing import List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from app.src.modules.cache import get_retrieval_cache
+from app.src.modules.databases import ConversationDB, PGVectorManager
+from app.src.modules.vector_index import VECTOR_TYPES
+
+logger = logging.getLogger("embedding_storage")
+
+CONVERSION_MODES = ("truncate", "reembed")
+
+
+def reduce_vector(vector: List[float], dimensions: int) -> List[float]:
+    """First dimensions of a vector, normalized to unit length"""
+    head = vector[:dimensions]
+    norm = math.sqrt(sum(value * value for value in head)) or 1.0
+    return [value / norm for value in head]
+
+
+def vector_bytes(dimensions: int, vector_type: str) -> int:
+    """Storage of one value of the pgvector type, 4 bytes per float32 and 2 per half"""
+    return 8 + dimensions * (4 if vector_type == "vector" else 2)
+
+
+async def get_collection(conn, collection_name: str):
+    result = await conn.execute(text("""
+        SELECT c.uuid, count(e.id), max(vector_dims(e.embedding))
+        FROM langchain_pg_collection c
+        LEFT JOIN langchain_pg_embedding e ON e.collection_id = c.uuid
+        WHERE c.name = :name
+        GROUP BY c.uuid
+    """), {"name": collection_name})
+    row = result.first()
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Collection {collection_name} not found")
+    return str(row[0]), row[1], row[2]
+
+
+async def set_collection_dimensions(conn, collection_id: str, dimensions: int) -> None:
+    # cmetadata is a json column, jsonb is only used to merge the key in
+    await conn.execute(text("""
+        UPDATE langchain_pg_collection
+        SET cmetadata = (COALESCE(cmetadata::jsonb, '{}'::jsonb)
+                         || jsonb_build_object('embedding_dimensions', CAST(:dimensions AS integer)))::json
+        WHERE uuid = CAST(:collection_id AS uuid)
+    """), {"collection_id": collection_id, "dimensions": dimensions})
+
+
+async def convert_collection(collection_name: str, dimensions: int, mode: str = "truncate",
+                             batch_size: int = 100) -> dict:
+    """Store a collection at a reduced embedding size
+
+    truncate shortens the stored vectors in SQL, reembed computes new vectors with
+    the API (through the embedding cache). Either way the vectors and the recorded
+    size of the collection change in one transaction. API workers keep the old size
+    and ANN index cached for a while, their searches fail on the size mismatch and
+    are retried with fresh lookups, see PGVectorManager.similarity_search. The ANN
+    index of the collection is dropped and has to be recreated for the new size.
+    Writes to the collection and the conversion exclude each other, see
+    PGVectorManager.collection_write_lock.
+    """
+    if mode not in CONVERSION_MODES:
+        raise HTTPException(status_code=400, detail=f"Mode must be one of {CONVERSION_MODES}")
+    pgmanager = PGVectorManager()
+    engine = pgmanager._get_engine(True)
+
+    # Held from the first read to the commit: a conversion does not start while
+    # documents are being added, and additions fail with a 409 until it is done
+    async with pgmanager.collection_write_lock(collection_name, exclusive=True):
+        async with engine.connect() as conn:
+            collection_id, row_count, current_dimensions = await get_collection(conn, collection_name)
+        if current_dimensions is None:
+            raise HTTPException(status_code=400, detail=f"Collection {collection_name} has no embeddings")
+        if mode == "truncate" and dimensions >= current_dimensions:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Can only truncate below the current {current_dimensions} dimensions, use reembed")
+
+        # The index expression casts to the old size and would fail on the new vectors
+        dropped = await pgmanager.get_index_manager().drop_index(collection_name)
+        if dropped:
+            logger.info(f"Dropped {dropped}, recreate the index once the conversion is done")
+
+        vectors = {}
+        if mode == "reembed":
+            embeddings = pgmanager._get_embeddings(dimensions)
+            async with engine.connect() as conn:
+                result = await conn.execute(text("""
+                    SELECT id, document FROM langchain_pg_embedding
+                    WHERE collection_id = CAST(:collection_id AS uuid)
+                """), {"collection_id": collection_id})
+                rows = result.fetchall()
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                batch_vectors = await embeddings.aembed_documents([row.document for row in batch])
+                vectors.update(zip([row.id for row in batch], batch_vectors))
+                logger.info(f"Embedded {min(start + batch_size, len(rows))}/{len(rows)} documents")
+
+        start_time = time.perf_counter()
+        async with engine.begin() as conn:
+            if mode == "truncate":
+                await conn.execute(text("""
+                    UPDATE langchain_pg_embedding
+                    SET embedding = l2_normalize(subvector(embedding, 1, :dimensions))
+                    WHERE collection_id = CAST(:collection_id AS uuid)
+                """), {"collection_id": collection_id, "dimensions": dimensions})
+            else:
+                await conn.execute(
+                    text("UPDATE langchain_pg_embedding SET embedding = CAST(:embedding AS vector) WHERE id = :id"),
+                    [{"id": doc_id, "embedding": json.dumps(vector)} for doc_id, vector in vectors.items()])
+            await set_collection_dimensions(conn, collection_id, dimensions)
+        logger.info(f"Converted {row_count} embeddings of {collection_name} from {current_dimensions} "
+                    f"to {dimensions} dimensions in {time.perf_counter() - start_time:.1f}s")
+
+    pgmanager.forget_collection(collection_name)
+    await get_retrieval_cache().bump_epoch(collection_name)
+    return {
+        "collection_name": collection_name,
+        "embeddings": row_count,
+        "from_dimensions": current_dimensions,
+        "to_dimensions": dimensions,
+        "dropped_indexes": dropped,
+    }
+
+
+async def sample_queries(conn, sample_size: int) -> List[str]:
+    """Most recent distinct user questions, the searches the collection actually serves"""
+    result = await conn.execute(text("""
+        SELECT question FROM (
+            SELECT DISTINCT ON (question) question, timestamp
+            FROM queries WHERE question IS NOT NULL AND question <> ''
+            ORDER BY question, timestamp DESC
+        ) recent
+        ORDER BY timestamp DESC LIMIT :sample_size
+    """), {"sample_size": sample_size})
+    return [row[0] for row in result]
+
+
+async def benchmark(collection_name: str, dimensions: List[int], k: int = 5, sample_size: int = 50,
+                    queries: Optional[List[str]] = None) -> dict:
+    """Size, exact scan latency and recall@k of every (dimensions, vector type) storage mode
+
+    Each mode is materialized in a temporary table from the stored vectors, and
+    recall is measured against an exact search over the collection as stored.
+    """
+    pgmanager = PGVectorManager()
+    engine = pgmanager._get_engine(True)
+    async with engine.connect() as conn:
+        collection_id, row_count, current_dimensions = await get_collection(conn, collection_name)
+        if current_dimensions is None:
+            raise HTTPException(status_code=400, detail=f"Collection {collection_name} has no embeddings")
+        if queries is None:
+            queries = await sample_queries(conn, sample_size)
+        if not queries:
+            raise HTTPException(status_code=400, detail="No queries to benchmark with")
+
+        collection_dimensions = await pgmanager.get_collection_dimensions(collection_name)
+        embeddings = pgmanager._get_embeddings(collection_dimensions)
+        query_vectors = [reduce_vector(await embeddings.aembed_query(query), current_dimensions)
+                         for query in queries]
+
+        # The stored vectors come first, they are the reference for recall
+        sizes = [current_dimensions] + sorted(size for size in set(dimensions) if size < current_dimensions)
+        modes = [(size, vector_type) for size in sizes for vector_type in VECTOR_TYPES]
+
+        truth = None
+        report = []
+        for size, vector_type in modes:
+            table = f"embedding_benchmark_{vector_type}_{size}"
+            column_type = f"{vector_type}({size})"
+            await conn.execute(text(f"""
+                CREATE TEMPORARY TABLE {table} AS
+                SELECT id, CAST(l2_normalize(subvector(embedding, 1, {size})) AS {column_type}) AS embedding
+                FROM langchain_pg_embedding
+                WHERE collection_id = CAST(:collection_id AS uuid)
+            """), {"collection_id": collection_id})
+            await conn.execute(text(f"ANALYZE {table}"))
+            result = await conn.execute(
+                text("SELECT pg_total_relation_size(CAST(:table AS regclass))"), {"table": table})
+            table_bytes = result.scalar()
+
+            latencies = []
+            results = []
+            for vector in query_vectors:
+                started = time.perf_counter()
+                result = await conn.execute(text(f"""
+                    SELECT id FROM {table}
+                    ORDER BY embedding <=> CAST(:embedding AS {column_type})
+                    LIMIT :k
+                """), {"embedding": json.dumps(reduce_vector(vector, size)), "k": k})
+                results.append([row[0] for row in result])
+                latencies.append((time.perf_counter() - started) * 1000)
+            if truth is None:
+                truth = results
+            recall = statistics.mean(
+                len(set(found) & set(expected)) / max(len(expected), 1)
+                for found, expected in zip(results, truth))
+
+            report.append({
+                "dimensions": size,
+                "vector_type": vector_type,
+                "vector_bytes": vector_bytes(size, vector_type),
+                "table_bytes": table_bytes,
+                f"recall_at_{k}": round(recall, 4),
+                "mean_ms": round(statistics.mean(latencies), 2),
+                "p95_ms": round(sorted(latencies)[int(0.95 * (len(latencies) - 1))], 2),
+            })
+            logger.info(f"Benchmarked {column_type}: {report[-1]}")
+        # Temporary tables go away with the transaction
+        await conn.rollback()
+
+    return {
+        "collection_name": collection_name,
+        "embeddings": row_count,
+        "stored_dimensions": current_dimensions,
+        "queries": len(queries),
+        "k": k,
+        "modes": report,
+    }
+
+
+async def main(args) -> None:
+    conversation_db = ConversationDB()
+    await conversation_db.open()
+    try:
+        if args.command == "convert":
+            result = await convert_collection(
+                args.collection, args.dimensions[0], mode=args.mode, batch_size=args.batch_size)
+        else:
+            queries = None
+            if args.queries_file:
+                with open(args.queries_file) as queries_file:
+                    queries = [line.strip() for line in queries_file if line.strip()]
+            result = await benchmark(
+                args.collection, args.dimensions, k=args.k, sample_size=args.sample_size, queries=queries)
+        print(json.dumps(result, indent=2))
+    finally:
+        await conversation_db.close()
+        await PGVectorManager().dispose()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(name)s: %(funcName)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    benchmark_parser = subparsers.add_parser("benchmark", help="compare storage modes on a collection")
+    benchmark_parser.add_argument("collection")
+    benchmark_parser.add_argument("--dimensions", type=int, nargs="+", default=[1024, 1536])
+    benchmark_parser.add_argument("--k", type=int, default=5)
+    benchmark_parser.add_argument("--sample-size", type=int, default=50,
+                                  help="number of recent user questions to search with")
+    benchmark_parser.add_argument("--queries-file", help="search with these queries instead, one per line")
+    convert_parser = subparsers.add_parser("convert", help="store a collection at a reduced size")
+    convert_parser.add_argument("collection")
+    convert_parser.add_argument("--dimensions", type=int, nargs=1, required=True)
+    convert_parser.add_argument("--mode", choices=CONVERSION_MODES, default="truncate")
+    convert_parser.add_argument("--batch-size", type=int, default=100)
+
+    asyncio.run(main(parser.parse_args()))
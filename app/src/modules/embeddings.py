@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+from array import array
+from typing import List, Optional
+
+import psycopg
+from langchain_core.embeddings import Embeddings
+from redis import asyncio as aioredis
+
+from app.src import constants
+from app.src.modules.cache import LRUTier, normalize_text, tier_stats
+
+logger = logging.getLogger("embeddings")
+
+
+def content_hash(text: str, model: str) -> str:
+    """sha256 of the model name and the normalized text"""
+    payload = f"{model}\x00{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def query_hash(query: str, model: str) -> str:
+    """Cache key for a search query, case is ignored on top of normalize_text"""
+    return content_hash(normalize_text(query).casefold(), model)
+
+
+class QueryEmbeddingCache:
+    """Two tier cache of query embeddings: an in-process LRU with a TTL in front of
+    a Redis tier shared by all the workers."""
+
+    def __init__(self, max_size: int, ttl: float, redis_ttl: int, redis_url: Optional[str]) -> None:
+        self.redis_ttl = redis_ttl
+        self.local = LRUTier(max_size, ttl)
+        self.redis = aioredis.from_url(redis_url) if redis_url else None
+        self.prefix = f"{os.environ.get('PROJECT_NAME')}:query_embedding:"
+        self.stats = {"lru_hits": 0, "redis_hits": 0, "misses": 0}
+
+    async def get(self, key: str) -> Optional[List[float]]:
+        vector = self.local.get(key)
+        if vector is not None:
+            self.stats["lru_hits"] += 1
+            return vector
+        if self.redis is not None:
+            try:
+                packed = await self.redis.get(self.prefix + key)
+            except Exception as err:
+                logger.warning(f"Query embedding cache: redis get failed: {err}")
+                packed = None
+            if packed is not None:
+                vector = array("f", packed).tolist()
+                self.local.set(key, vector)
+                self.stats["redis_hits"] += 1
+                return vector
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, vector: List[float]) -> None:
+        self.local.set(key, vector)
+        if self.redis is not None:
+            try:
+                await self.redis.set(
+                    self.prefix + key, array("f", vector).tobytes(), ex=self.redis_ttl)
+            except Exception as err:
+                logger.warning(f"Query embedding cache: redis set failed: {err}")
+
+    def get_stats(self) -> dict:
+        return tier_stats(self.stats, self.local)
+
+
+query_embedding_cache = None
+
+
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    """Process-wide query embedding cache, created on first use"""
+    global query_embedding_cache
+    if query_embedding_cache is None:
+        query_embedding_cache = QueryEmbeddingCache(
+            max_size=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", constants.QUERY_EMBEDDING_CACHE_SIZE)),
+            ttl=float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", constants.QUERY_EMBEDDING_CACHE_TTL)),
+            redis_ttl=int(os.getenv("QUERY_EMBEDDING_REDIS_TTL", constants.QUERY_EMBEDDING_REDIS_TTL)),
+            redis_url=os.environ.get("REDIS_URL"),
+        )
+    return query_embedding_cache
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that looks document vectors up in the embedding_cache table
+    before calling the underlying model, and stores the ones it had to compute.
+    Query vectors go through the QueryEmbeddingCache."""
+
+    def __init__(self, embeddings: Embeddings, model: str, db) -> None:
+        self.embeddings = embeddings
+        self.model = model
+        self.db = db
+        self.query_cache = get_query_embedding_cache()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # The cache lives behind the async pool, sync callers go straight to the model
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        # Sync callers only get the in-process tier
+        key = query_hash(text, self.model)
+        vector = self.query_cache.local.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.query_cache.local.set(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = query_hash(text, self.model)
+        vector = await self.query_cache.get(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await self.query_cache.set(key, vector)
+        return vector
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [content_hash(text, self.model) for text in texts]
+        try:
+            cached = await self.db.get_cached_embeddings(list(set(hashes)))
+        except psycopg.Error as err:
+            logger.exception(err)
+            cached = {}
+
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+        logger.info(
+            f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            try:
+                await self.db.insert_cached_embeddings(self.model, computed)
+            except psycopg.Error as err:
+                logger.exception(err)
+            cached.update(computed)
+
+        return [list(cached[text_hash]) for text_hash in hashes]
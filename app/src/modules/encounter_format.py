@@ -0,0 +1,117 @@
+"""Compact text encoding of the encounter data handed to the LLM.
+
+Each section is a table: one header line with the columns that have a value in
+at least one row, then one "|" separated line per row. Bookkeeping columns
+(ids, flags, audit fields, signatures) are dropped, free text is truncated, and
+rows are added until the token budget is spent. A share of the budget is kept
+for the encounters, which the tool is mostly asked to summarize, so a long
+medication list cannot crowd them out. They come last, most recent first, and
+get the rest of the budget too, so a long history loses its oldest encounters.
+"""
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+
+import tiktoken
+
+from app.src import constants
+
+logger = logging.getLogger("encounter_format")
+
+# section of extract_encounter_data -> (title, columns kept, in order)
+SECTIONS = [
+    ("allergies", "Allergies", [
+        "allergy", "allergytype", "severitiesCode", "allergiesStatus", "dateOfOnSet", "comment"]),
+    ("current_medications", "Current medications", [
+        "drugname", "drugbrandname", "dose", "unit", "route", "frequency", "duration",
+        "direction", "instruction", "startedon", "reason", "comment"]),
+    ("recent_vitals", "Recent vitals", [
+        "recordDate", "recordTime", "weightKilo", "weightGram", "weightUnit", "heightFt",
+        "heightIn", "heightUnit", "bmi", "temperatureF", "systolicBloodPressure",
+        "diastolicBloodPressure", "respiratoryRate", "pulseBpm", "bloodSugar", "fasting",
+        "o2Saturation"]),
+    ("encounters", "Encounters, most recent first", [
+        "startDate", "endDate", "encounterTypeCode", "duration", "soapForm"]),
+]
+
+encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global encoding
+    if encoding is None:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return len(encoding.encode(text))
+
+
+def format_value(value, max_chars: int) -> str:
+    if value is None:
+        return ""
+    text = re.sub(r"\s+", " ", str(value).replace("|", "/")).strip()
+    # Dates without a time of day
+    text = re.sub(r"^(\d{4}-\d{2}-\d{2})[ T]00:00:00$", r"\1", text)
+    if len(text) > max_chars:
+        text = text[:max_chars].rstrip() + "…"
+    return text
+
+
+def encode_section(title: str, rows: List[dict], columns: List[str], budget: int,
+                   max_chars: int) -> Tuple[List[str], int]:
+    """Lines of a section that fit in budget, and the tokens they use"""
+    cells = [[format_value(row.get(column), max_chars) for column in columns] for row in rows]
+    kept = [i for i, column in enumerate(columns) if any(row[i] for row in cells)]
+    if not kept:
+        line = f"{title} ({len(rows)}): no details recorded"
+        return [line], count_tokens(line)
+
+    lines = [f"{title} ({len(rows)}):", "|".join(columns[i] for i in kept)]
+    used = sum(count_tokens(line) for line in lines)
+    if used > budget:
+        return [], 0
+    for shown, row in enumerate(cells):
+        line = "|".join(row[i] for i in kept)
+        tokens = count_tokens(line)
+        if used + tokens > budget:
+            lines.append(f"... {len(rows) - shown} more not shown")
+            used += count_tokens(lines[-1])
+            break
+        lines.append(line)
+        used += tokens
+    return lines, used
+
+
+def encode_encounter_data(data: dict, token_budget: Optional[int] = None,
+                          max_chars: Optional[int] = None,
+                          encounters_share: Optional[float] = None) -> str:
+    """Encode the dict of extract_encounter_data in about token_budget tokens"""
+    if token_budget is None:
+        token_budget = int(os.getenv("ENCOUNTER_DATA_TOKEN_BUDGET", constants.ENCOUNTER_DATA_TOKEN_BUDGET))
+    if max_chars is None:
+        max_chars = int(os.getenv("ENCOUNTER_TEXT_MAX_CHARS", constants.ENCOUNTER_TEXT_MAX_CHARS))
+    if encounters_share is None:
+        encounters_share = float(os.getenv("ENCOUNTER_DATA_ENCOUNTERS_SHARE", constants.ENCOUNTER_DATA_ENCOUNTERS_SHARE))
+    # Kept for the encounters while the other sections are encoded
+    reserved = int(token_budget * encounters_share) if data.get("encounters") else 0
+
+    lines = [f"Patient {data.get('patient_id')}, "
+             f"{data.get('total_encounters', 0)} active encounters, "
+             f"data as of {format_value(data.get('data_extracted_at'), max_chars)}"]
+    used = count_tokens(lines[0])
+    for key, title, columns in SECTIONS:
+        rows = data.get(key) or []
+        if not rows:
+            lines.append(f"{title}: none")
+            used += count_tokens(lines[-1])
+            continue
+        budget = token_budget - used - (0 if key == "encounters" else reserved)
+        section, tokens = encode_section(title, rows, columns, budget, max_chars)
+        if not section:
+            lines.append(f"{title}: {len(rows)} not shown")
+            used += count_tokens(lines[-1])
+            continue
+        lines.extend(section)
+        used += tokens
+
+    logger.info(f"Encoded encounter data of patient {data.get('patient_id')} in {used} tokens")
+    return "\n".join(lines)
@@ -0,0 +1,59 @@
+import json
+import logging
+from typing import Dict, List, Optional
+
+from langchain_core.documents import Document
+from sqlalchemy import text
+
+from app.src import constants
+
+logger = logging.getLogger("full_text")
+
+# Generated column added by migration 0002
+TSV_COLUMN = "document_tsv"
+
+
+async def full_text_search(conn, collection_name: str, query: str, k: int, config: str,
+                           search_filter: Optional[dict] = None) -> List[Document]:
+    """Chunks matching any of the query terms, ranked by ts_rank_cd
+
+    plainto_tsquery ANDs the terms, which a whole question rarely matches, so
+    they are ORed and the ranking favours chunks that match more of them.
+    """
+    result = await conn.execute(text(f"""
+        WITH q AS (
+            SELECT to_tsquery(CAST(:config AS regconfig),
+                              replace(plainto_tsquery(CAST(:config AS regconfig), :query)::text, '&', '|')) AS query
+        )
+        SELECT e.id, e.document, e.cmetadata
+        FROM langchain_pg_embedding e, q
+        WHERE e.collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection_name)
+        AND e.{TSV_COLUMN} @@ q.query
+        AND e.cmetadata @> CAST(:filter AS jsonb)
+        ORDER BY ts_rank_cd(e.{TSV_COLUMN}, q.query) DESC
+        LIMIT :k
+    """), {
+        "config": config,
+        "query": query,
+        "collection_name": collection_name,
+        "filter": json.dumps(search_filter or {}),
+        "k": k,
+    })
+    return [Document(id=str(row.id), page_content=row.document, metadata=row.cmetadata)
+            for row in result]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int,
+                           rank_constant: int = constants.HYBRID_SEARCH_RRF_K) -> List[Document]:
+    """Merge ranked lists by sum(1 / (rank_constant + rank)), documents found by several
+    searches rise to the top"""
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            # Not every search path returns ids, the chunk text identifies a chunk on all of them
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rank_constant + rank)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [docs[key] for key in ranked[:k]]
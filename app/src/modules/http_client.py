@@ -0,0 +1,57 @@
+import importlib.util
+import logging
+import os
+
+import httpx
+
+from app.src import constants
+
+logger = logging.getLogger("http_client")
+
+# Shared by every OpenAI chat and embeddings client of the process, so their calls
+# reuse kept-alive connections instead of each client opening its own
+async_client = None
+sync_client = None
+
+
+def client_settings() -> dict:
+    return {
+        "limits": httpx.Limits(
+            max_connections=int(os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", constants.OPENAI_HTTP_MAX_CONNECTIONS)),
+            max_keepalive_connections=int(os.getenv("OPENAI_HTTP_MAX_KEEPALIVE", constants.OPENAI_HTTP_MAX_KEEPALIVE)),
+            keepalive_expiry=float(os.getenv("OPENAI_HTTP_KEEPALIVE_EXPIRY", constants.OPENAI_HTTP_KEEPALIVE_EXPIRY)),
+        ),
+        "timeout": httpx.Timeout(
+            float(os.getenv("OPENAI_HTTP_TIMEOUT", constants.OPENAI_HTTP_TIMEOUT)),
+            connect=float(os.getenv("OPENAI_HTTP_CONNECT_TIMEOUT", constants.OPENAI_HTTP_CONNECT_TIMEOUT)),
+        ),
+        # HTTP/2 needs the h2 package (httpx[http2])
+        "http2": importlib.util.find_spec("h2") is not None,
+    }
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Process-wide async client, created on first use"""
+    global async_client
+    if async_client is None or async_client.is_closed:
+        async_client = httpx.AsyncClient(**client_settings())
+        logger.info("Created the shared async HTTP client")
+    return async_client
+
+
+def get_http_client() -> httpx.Client:
+    """Process-wide client of the sync calls (sync embeddings, retrievers)"""
+    global sync_client
+    if sync_client is None or sync_client.is_closed:
+        sync_client = httpx.Client(**client_settings())
+    return sync_client
+
+
+async def close_http_clients() -> None:
+    global async_client, sync_client
+    if async_client is not None:
+        await async_client.aclose()
+        async_client = None
+    if sync_client is not None:
+        sync_client.close()
+        sync_client = None
@@ -0,0 +1,252 @@
+"""Versioned schema migrations of the conversation database.
+
+Migrations are the numbered SQL files of app/migrations, applied in order and
+recorded in schema_migrations. "-- migrate: OPTION" lines at the top of a file
+set how it runs:
+
+- no-transaction: statement by statement outside a transaction, which CREATE
+  INDEX CONCURRENTLY needs; its statements end with ";" at the end of a line.
+- maintenance-window: the migration blocks the tables it changes, it is only
+  applied with --maintenance.
+
+Migrations are a deploy step, run before the new containers start:
+
+    python -m app.src.modules.migrations status
+    python -m app.src.modules.migrations migrate [--to VERSION] [--maintenance]
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import psycopg
+from psycopg import sql
+
+logger = logging.getLogger("migrations")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), "migrations")
+MIGRATION_FILE_PATTERN = re.compile(r"^(\d{4})_(\w+)\.sql$")
+OPTION_PREFIX = "-- migrate:"
+# Serializes migration runs started from several containers at once
+MIGRATION_LOCK = "schema_migrations"
+CONCURRENT_INDEX_PATTERN = re.compile(
+    r"^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)",
+    re.IGNORECASE | re.MULTILINE)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+
+    @property
+    def checksum(self) -> str:
+        return hashlib.sha256(self.sql.encode("utf-8")).hexdigest()
+
+    @property
+    def options(self) -> List[str]:
+        """Options of the "-- migrate:" lines heading the file"""
+        options = []
+        for line in self.sql.lstrip().splitlines():
+            if not line.startswith(OPTION_PREFIX):
+                break
+            options.append(line[len(OPTION_PREFIX):].strip())
+        return options
+
+    @property
+    def transactional(self) -> bool:
+        return "no-transaction" not in self.options
+
+    @property
+    def needs_maintenance_window(self) -> bool:
+        return "maintenance-window" in self.options
+
+    def statements(self) -> List[str]:
+        """Statements of the file, split on the ";" that end a line"""
+        statements = []
+        for statement in re.split(r";[ \t]*$", self.sql, flags=re.MULTILINE):
+            code = [line for line in statement.splitlines()
+                    if line.strip() and not line.strip().startswith("--")]
+            if code:
+                statements.append(statement.strip())
+        return statements
+
+
+def load_migrations(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    migrations = {}
+    for file_name in sorted(os.listdir(directory)):
+        match = MIGRATION_FILE_PATTERN.match(file_name)
+        if match is None:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise ValueError(f"Two migrations have version {version}")
+        with open(os.path.join(directory, file_name)) as migration_file:
+            migrations[version] = Migration(version, match.group(2), migration_file.read())
+    return [migrations[version] for version in sorted(migrations)]
+
+
+async def pending_versions(conn) -> List[int]:
+    """Versions not applied yet, read only so the app can check at startup"""
+    cursor = await conn.execute("SELECT to_regclass('public.schema_migrations')")
+    if (await cursor.fetchone())[0] is None:
+        applied = set()
+    else:
+        cursor = await conn.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in await cursor.fetchall()}
+    return [migration.version for migration in load_migrations() if migration.version not in applied]
+
+
+def get_applied(conn) -> Dict[int, dict]:
+    rows = conn.execute('''
+        SELECT version, name, checksum, applied_at, duration_ms
+        FROM schema_migrations ORDER BY version
+    ''').fetchall()
+    return {row[0]: {"name": row[1], "checksum": row[2], "applied_at": row[3], "duration_ms": row[4]}
+            for row in rows}
+
+
+def ensure_migrations_table(conn) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version integer PRIMARY KEY,
+            name text NOT NULL,
+            checksum text NOT NULL,
+            applied_at timestamp DEFAULT current_timestamp,
+            duration_ms double precision
+        )
+    ''')
+
+
+def apply_migration(conn, migration: Migration) -> None:
+    logger.info(f"Applying {migration.version:04d}_{migration.name}")
+    start_time = time.perf_counter()
+    if migration.transactional:
+        with conn.transaction():
+            conn.execute(migration.sql)
+            record_migration(conn, migration, start_time)
+    else:
+        # A failed statement leaves the version unrecorded, the statements are
+        # IF NOT EXISTS so the migration can run again, once the invalid index a
+        # failed concurrent build leaves behind is dropped
+        for statement in migration.statements():
+            drop_invalid_index(conn, statement)
+            conn.execute(statement)
+        record_migration(conn, migration, start_time)
+
+
+def drop_invalid_index(conn, statement: str) -> None:
+    """Drop the index a CREATE INDEX CONCURRENTLY IF NOT EXISTS statement builds if
+    it is invalid, IF NOT EXISTS would skip it and leave it unusable"""
+    match = CONCURRENT_INDEX_PATTERN.search(statement)
+    if match is None:
+        return
+    index_name = match.group(1)
+    invalid = conn.execute('''
+        SELECT 1
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace AND NOT i.indisvalid
+    ''', (index_name,)).fetchone()
+    if invalid is not None:
+        logger.warning(f"Dropping {index_name}, left invalid by a failed build")
+        conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(index_name)))
+
+
+def record_migration(conn, migration: Migration, start_time: float) -> None:
+    duration_ms = (time.perf_counter() - start_time) * 1000
+    conn.execute('''
+        INSERT INTO schema_migrations (version, name, checksum, duration_ms)
+        VALUES (%s, %s, %s, %s)
+    ''', (migration.version, migration.name, migration.checksum, duration_ms))
+    logger.info(f"Applied {migration.version:04d}_{migration.name} in {duration_ms:.0f}ms")
+
+
+def migrate(conn_string: str, target: Optional[int] = None, maintenance: bool = False) -> List[int]:
+    """Apply the pending migrations up to target, returns the applied versions
+
+    Stops with a RuntimeError at a maintenance-window migration unless maintenance
+    is set, the migrations before it stay applied.
+    """
+    applied_versions = []
+    with psycopg.connect(conn_string, autocommit=True) as conn:
+        conn.execute("SELECT pg_advisory_lock(hashtext(%s))", (MIGRATION_LOCK,))
+        try:
+            ensure_migrations_table(conn)
+            applied = get_applied(conn)
+            for migration in load_migrations():
+                if target is not None and migration.version > target:
+                    break
+                if migration.version in applied:
+                    if applied[migration.version]["checksum"] != migration.checksum:
+                        logger.warning(f"{migration.version:04d}_{migration.name} changed after it was applied")
+                    continue
+                if migration.needs_maintenance_window and not maintenance:
+                    raise RuntimeError(
+                        f"{migration.version:04d}_{migration.name} blocks the tables it changes, "
+                        "apply it in a maintenance window with migrate --maintenance")
+                apply_migration(conn, migration)
+                applied_versions.append(migration.version)
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(hashtext(%s))", (MIGRATION_LOCK,))
+    if not applied_versions:
+        logger.info("No pending migrations")
+    return applied_versions
+
+
+def status(conn_string: str) -> List[dict]:
+    with psycopg.connect(conn_string, autocommit=True) as conn:
+        exists = conn.execute("SELECT to_regclass('public.schema_migrations')").fetchone()[0]
+        applied = get_applied(conn) if exists is not None else {}
+    report = []
+    for migration in load_migrations():
+        record = applied.get(migration.version)
+        if record is None:
+            state = "pending"
+        elif record["checksum"] != migration.checksum:
+            state = "changed"
+        else:
+            state = "applied"
+        report.append({
+            "version": migration.version,
+            "name": migration.name,
+            "state": state,
+            "applied_at": record["applied_at"] if record else None,
+        })
+    return report
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from app.src.modules.databases import get_connection_string
+
+    load_dotenv()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(name)s: %(funcName)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="list the migrations and whether they are applied")
+    migrate_parser = subparsers.add_parser("migrate", help="apply the pending migrations")
+    migrate_parser.add_argument("--to", type=int, help="stop after this version")
+    migrate_parser.add_argument("--maintenance", action="store_true",
+                                help="also apply the migrations that need a maintenance window")
+    args = parser.parse_args()
+
+    conn_string = get_connection_string()
+    if args.command == "status":
+        for migration in status(conn_string):
+            print(f"{migration['version']:04d}_{migration['name']:<40} {migration['state']:<8} "
+                  f"{migration['applied_at'] or ''}")
+    else:
+        try:
+            migrate(conn_string, target=args.to, maintenance=args.maintenance)
+        except RuntimeError as err:
+            logger.error(str(err))
+            sys.exit(1)
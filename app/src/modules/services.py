@@ -1,7 +1,10 @@
 from abc import abstractmethod
+import asyncio
+from contextvars import ContextVar
 import logging
 from dotenv import load_dotenv
 import os
+import re
 import time
 import traceback
 from langchain_openai import ChatOpenAI
@@ -14,12 +17,14 @@ from langchain.agents.format_scratchpad.openai_tools import (
 )
 from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputParser
 from app.src import constants
-from sqlalchemy import create_engine
 from app.src.modules.databases import (
+    ACTIVE_EMBEDDINGS_FILTER,
     PGVectorManager,
-    get_alchemy_conn_string,
     ConversationDB,
 )
+from app.src.modules.cache import normalize_text
+from app.src.modules.encounter_format import encode_encounter_data
+from app.src.modules.http_client import get_async_http_client, get_http_client
 
 from app.src.constants import PROMPT, DATA
 from redis import asyncio as aioredis
@@ -30,6 +35,87 @@ from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 INPUT_KEY = "{input}"
 load_dotenv()
 
+# User of the request an agent is answering. Agents are shared by the requests
+# of a worker, so the tools read the user from the context of the invocation
+agent_user_id: ContextVar = ContextVar("agent_user_id", default=None)
+# Sources of the documents semantic_search retrieved, collected when streaming
+agent_sources: ContextVar = ContextVar("agent_sources", default=None)
+# Search of the raw input started alongside the first LLM call of a turn
+agent_speculative_search: ContextVar = ContextVar("agent_speculative_search", default=None)
+
+logger = logging.getLogger("services")
+
+
+async def knowledge_base_search(search_term: str):
+    """The search of the semantic_search tool"""
+    return await PGVectorManager().search(
+        os.environ.get("VECTORSTORE_COLLECTION_NAME"),
+        search_term,
+        k=5,
+        search_filter=ACTIVE_EMBEDDINGS_FILTER,
+        hybrid=True,
+    )
+
+
+def search_terms(text: str) -> set:
+    return set(re.findall(r"\w+", normalize_text(text).casefold()))
+
+
+class SpeculativeSearch:
+    """Knowledge base search of a turn's input, started before the model asks for
+    one. The first LLM call of a turn mostly decides to search for about the
+    user's question, so one semantic_search call whose search term is close to
+    the input gets this result, and the turn saves a sequential search.
+
+    Close is a Jaccard similarity of their words: a term covering only part of
+    the question, as when the model splits it into several searches, does not
+    get the result of the whole question."""
+
+    def __init__(self, query: str, min_similarity: float) -> None:
+        self.terms = search_terms(query)
+        self.min_similarity = min_similarity
+        self.claimed = False
+        self.task = asyncio.create_task(self.run(query))
+
+    async def run(self, query: str):
+        try:
+            return await knowledge_base_search(query)
+        except Exception as err:
+            # The tool falls back to its own search
+            logger.warning(f"Speculative search failed: {err}")
+            return None
+
+    def matches(self, search_term: str) -> bool:
+        terms = search_terms(search_term)
+        if not terms or not self.terms:
+            return False
+        return len(terms & self.terms) / len(terms | self.terms) >= self.min_similarity
+
+    def claim(self, search_term: str) -> bool:
+        """Whether this call gets the result, only the first close one of the turn"""
+        if self.claimed or not self.matches(search_term):
+            return False
+        self.claimed = True
+        return True
+
+    def cancel(self) -> None:
+        """Stop the search if the turn ended without needing it"""
+        if not self.task.done():
+            self.task.cancel()
+
+
+def start_speculative_search(query: str):
+    if os.getenv("SPECULATIVE_SEARCH", str(constants.SPECULATIVE_SEARCH)).lower() != "true":
+        return None
+    min_similarity = float(os.getenv("SPECULATIVE_SEARCH_MIN_SIMILARITY", constants.SPECULATIVE_SEARCH_MIN_SIMILARITY))
+    return SpeculativeSearch(query, min_similarity)
+
+
+def prompt_language(language=None) -> str:
+    """The prompts have an English and a Spanish version, Spanish is the default"""
+    return "en" if language == "en" else "es"
+
+
 class Agent:
     @abstractmethod
     async def _create_agent(self) -> None:
@@ -40,14 +126,63 @@ class Agent:
         pass
 
     @abstractmethod
-    async def qa(self, query: str, history: list) -> str:
+    async def qa(self, query: str, history: list, user_id=None) -> str:
         pass
 
 
+def history_messages(chat_history) -> list:
+    """Chat history rows ({"prompt", "response"}) as messages of the prompt"""
+    extracted_data = []
+    for item in chat_history or []:
+        if not isinstance(item, dict):
+            continue
+
+        prompt = item.get("prompt")
+        if prompt:
+            extracted_data.append({"role": "human", "content": prompt})
+
+        response = item.get("response")
+        if response is not None:
+            extracted_data.append({"role": "assistant", "content": response})
+    return extracted_data
+
+
+def steps_context(intermediate_steps) -> str:
+    """The tool outputs of an agent run, stored with the answer as its context"""
+    context = ""
+    for step in intermediate_steps or []:
+        if isinstance(step[-1], str):
+            context = context + ";" + step[-1]
+        else:
+            context = context + ";" + str(step[-1])
+    return context
+
+
 class LLMAgentFactory:
     """class for llm agent"""
 
-    async def create(self) -> Agent:
+    # (model, prompt language) -> OpenAI agent of this worker, built once and
+    # shared by the requests
+    agents = {}
+
+    async def get_openai_agent(self, llm_id: str, language=None) -> Agent:
+        key = (llm_id, prompt_language(language))
+        agent = self.agents.get(key)
+        if agent is None:
+            agent = OPENAIAgent(llm_id)
+            await agent._build_prompt(language)
+            await agent._create_agent()
+            self.agents[key] = agent
+        return agent
+
+    async def prebuild(self) -> None:
+        """Build the agents of the configured model at startup"""
+        llm_id = os.environ.get("OPENAI_MODEL")
+        if llm_id in constants.OPENAI_MODELS:
+            for language in ("en", "es"):
+                await self.get_openai_agent(llm_id, language)
+
+    async def create(self, language=None) -> Agent:
         logger = logging.getLogger("LLMAgentFactory")
 
         REDIS_URL = os.environ.get("REDIS_URL")
@@ -65,10 +200,12 @@ class LLMAgentFactory:
         #llm_id = "gpt-4o-mini"
         else:
             if llm_id in constants.OPENAI_MODELS:
-                agent = OPENAIAgent()
-                return agent
+                return await self.get_openai_agent(llm_id, language)
             elif llm_id in constants.BEDROCK_MODELS:
+                # Its prompt settings are read from redis, so it is built per request
                 agent = BedrockAgent()
+                await agent._build_prompt(language)
+                await agent._create_agent()
                 return agent
             else:
                 resp = "LLM not in allowed list"
@@ -81,49 +218,40 @@ class LLMAgentFactory:
 class OPENAIAgent(Agent):
     """class for function calling rag agent"""
 
-    def __init__(self) -> None:
+    def __init__(self, llm_model_id=None) -> None:
         self.logger = logging.getLogger("OPENAIAgent")
-        self.conn_string = get_alchemy_conn_string()
-        self.logger.info("connection string: %s", self.conn_string)
-        self.engine = create_engine(self.conn_string)
         self.db = ConversationDB()
-        self.user_id = None  # Will be set when agent is created
-
-    def set_user_id(self, user_id: int):
-        """Set the user ID for this agent instance"""
-        self.user_id = user_id
-        self.logger.info(f"User ID set for agent: {user_id}")
+        self.llm_model_id = llm_model_id or os.environ.get("OPENAI_MODEL")
 
     async def _create_agent(self) -> None:
-        self.llm = ChatOpenAI(model=self.llm_model_id, temperature=0.3)
+        self.llm = ChatOpenAI(
+            model=self.llm_model_id,
+            temperature=0.3,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
+        )
 
         @tool
         async def semantic_search(search_term: str):
             """
-            This function utilizes a vector store to retrieve relevant documents based on the semantic similarity of their content to the provided search term.
+            This function utilizes a vector store to retrieve relevant documents based on the semantic similarity of their content to the provided search term, and on the exact terms (product, drug and screen names) it contains.
             """
-            result = await self.db.get_active_files()
-            VECTORSTORE_COLLECTION_NAME = os.environ.get("VECTORSTORE_COLLECTION_NAME")
-            pgmanager = PGVectorManager()
-            retriever = pgmanager.return_vector_store(
-                VECTORSTORE_COLLECTION_NAME, async_mode=False
-            )
             context = ""
-            active_files = []
-            print("#######################", result)
-            for filename_tuple in result:
 
-                filename = filename_tuple[0]
-                # Extract the filename from the tuple
-                active_files.append(filename)
-
-            docs = retriever.similarity_search(
-                search_term, k=5, filter={"source": active_files}
-            )
+            docs = None
+            speculative = agent_speculative_search.get()
+            if speculative is not None and speculative.claim(search_term):
+                docs = await speculative.task
+                if docs is not None:
+                    self.logger.info(f"semantic_search({search_term!r}) served by the speculative search")
+            if docs is None:
+                docs = await knowledge_base_search(search_term)
             for doc in docs:
                 content = doc.page_content
                 context = context + content
-            pgmanager.close()
+            sources = agent_sources.get()
+            if sources is not None:
+                sources.extend(doc.metadata.get("source") for doc in docs)
             print("-------------------------------------------------------")
             print(context)
             return context
@@ -137,14 +265,17 @@ class OPENAIAgent(Agent):
             This function automatically uses the user's ID from the request header to retrieve their own medical data.
             No parameters are needed as the user ID is already set from the request header.
             """
-            if self.user_id is None:
+            user_id = agent_user_id.get()
+            if user_id is None:
                 self.logger.error("get_encounter_data called but no user_id is set")
                 return "Error: No user ID available from request header. Please ensure the userId header is set."
             
-            self.logger.info(f"Retrieving encounter data for user_id: {self.user_id}")
+            self.logger.info(f"Retrieving encounter data for user_id: {user_id}")
             from app.src.view import extract_encounter_data
-            result = extract_encounter_data(self.user_id)
-            self.logger.info(f"Encounter data retrieval completed for user_id: {self.user_id}")
+            result = await extract_encounter_data(user_id)
+            if isinstance(result, dict):
+                result = encode_encounter_data(result)
+            self.logger.info(f"Encounter data retrieval completed for user_id: {user_id}")
             return result
 
         tools = [semantic_search, get_encounter_data]
@@ -181,6 +312,8 @@ class OPENAIAgent(Agent):
             | self.llm_with_tools
             | OpenAIToolsAgentOutputParser()
         )
+        # Tool calls the model makes in one step run concurrently, the async
+        # AgentExecutor gathers them
         self.agent_executor = AgentExecutor(
             agent=agent,
             tools=tools,
@@ -190,7 +323,6 @@ class OPENAIAgent(Agent):
 
     async def _build_prompt(self, language=None):
         self.logger.info(f"[DEBUG] _build_prompt called with language: {language}")
-        self.llm_model_id = os.environ.get("OPENAI_MODEL")
         # Update prompt based on language
         if language == "en":
             self.prompt = PROMPT + "\n\n**CRITICAL INSTRUCTION**: From now on, respond only in English, regardless of previous conversation language. Do NOT respond in Spanish or any other language."
@@ -204,56 +336,77 @@ class OPENAIAgent(Agent):
             self.prompt = PROMPT + spanish_instruction
         self.logger.info(f"[DEBUG] Prompt set in _build_prompt: {self.prompt}")
 
-    async def qa(self, query, chat_history):
+    async def qa(self, query, chat_history, user_id=None):
+        user_token = agent_user_id.set(user_id)
+        speculative = start_speculative_search(query)
+        search_token = agent_speculative_search.set(speculative)
         try:
-            extracted_data = []
-
-            for item in chat_history:
-
-                # human = {"role": "human", "content": item["prompt"]}
-                # extracted_data.append(human)
-                # if item["response"] != None:
-                #     assistant = {"role": "assistant", "content": item["response"]}
-                if not isinstance(item, dict):
-                    continue
-                    
-                prompt = item.get("prompt")
-                if prompt:
-                    human = {"role": "human", "content": prompt}
-                    extracted_data.append(human)
-                
-                response = item.get("response")
-                if response is not None:
-                    assistant = {"role": "assistant", "content": response}
-                    extracted_data.append(assistant)
-
             response = await self.agent_executor.ainvoke(
-                {"input": query, "chat_history": extracted_data}
+                {"input": query, "chat_history": history_messages(chat_history)}
             )
 
-            self.engine.dispose()
-
             result = response["output"]
             self.logger.critical("result: " + result)
-            if response["intermediate_steps"]:
-                context = ""
-                for step in response["intermediate_steps"]:
-                    if isinstance(step[-1], str):
-                        context = context + ";" + step[-1]
-                    elif isinstance(step[-1], dict) and len(step[-1]) > 1:
-                        # Handle case where step[-1] is a dict with multiple items
-                        context = context + ";" + str(step[-1])
-                    else:
-                        # Handle other cases safely
-                        context = context + ";" + str(step[-1])
-
-                return result, context
-
-            return result, ""
+            return result, steps_context(response["intermediate_steps"])
         except Exception as e:
             self.logger.exception(traceback.format_exc())
             # Return a default response instead of None
             return "I apologize, but I encountered an error processing your request. Please try again.", ""
+        finally:
+            agent_user_id.reset(user_token)
+            agent_speculative_search.reset(search_token)
+            if speculative is not None:
+                speculative.cancel()
+
+    async def stream(self, query, chat_history, user_id=None):
+        """Yield (event, data) as the agent runs: tool_start, tool_end, sources and
+        token events, then an end event with the response and context that qa returns"""
+        user_token = agent_user_id.set(user_id)
+        speculative = start_speculative_search(query)
+        search_token = agent_speculative_search.set(speculative)
+        sources = []
+        sources_token = agent_sources.set(sources)
+        sent_sources = set()
+        response, context = "", ""
+
+        try:
+            async for event in self.agent_executor.astream_events(
+                {"input": query, "chat_history": history_messages(chat_history)},
+                version="v2",
+            ):
+                kind = event["event"]
+                if kind == "on_chat_model_stream":
+                    # The rounds deciding on tool calls stream tool call chunks, not content
+                    token = event["data"]["chunk"].content
+                    if token:
+                        yield "token", {"token": token}
+                elif kind == "on_tool_start":
+                    yield "tool_start", {"name": event["name"], "input": event["data"].get("input")}
+                elif kind == "on_tool_end":
+                    yield "tool_end", {"name": event["name"]}
+                    new_sources = [source for source in dict.fromkeys(sources)
+                                   if source and source not in sent_sources]
+                    if new_sources:
+                        sent_sources.update(new_sources)
+                        yield "sources", {"sources": new_sources}
+                elif kind == "on_chain_end" and event["name"] == "AgentExecutor":
+                    output = event["data"]["output"]
+                    response = output["output"]
+                    context = steps_context(output.get("intermediate_steps"))
+        finally:
+            # Also runs when the client disconnects or the run fails. The WebSocket
+            # handler streams every turn of a connection from one task, so the
+            # context vars are reset like in qa()
+            if speculative is not None:
+                speculative.cancel()
+            try:
+                agent_sources.reset(sources_token)
+                agent_speculative_search.reset(search_token)
+                agent_user_id.reset(user_token)
+            except ValueError:
+                # The generator was closed from another context, which never saw them set
+                pass
+        yield "end", {"response": response, "context": context}
 
 
 class BedrockAgent(Agent):
@@ -346,7 +499,8 @@ You can use the following glossary to interpret the user's question:
     async def retriever_chain(self):
         manager = PGVectorManager()
         VECTORSTORE_COLLECTION_NAME = os.environ.get("VECTORSTORE_COLLECTION_NAME")
-        retriever = manager.get_retriever(VECTORSTORE_COLLECTION_NAME, True)
+        retriever = manager.get_retriever(
+            VECTORSTORE_COLLECTION_NAME, True, search_kwargs={"hybrid": True})
         retrieverprompt = self.retrieverprompt
         retriever_query_chain = retrieverprompt | self.llm | StrOutputParser()
 
@@ -359,7 +513,7 @@ You can use the following glossary to interpret the user's question:
             parsed_output = parsed_output + document.page_content + "\n\n"
         return parsed_output
 
-    async def qa(self, query, chat_history):
+    async def qa(self, query, chat_history, user_id=None):
         total_start_time = time.time()
         retrieverchain, retriever_query_chain = await self.retriever_chain()
         retriever_query_creation_start_time = time.time()
@@ -394,7 +548,12 @@ async def simple_openai_chat(prompt: str) -> str:
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY environment variable not set.")
-    llm = ChatOpenAI(model=model, openai_api_key=api_key, temperature=0.3)
+    llm = ChatOpenAI(
+        model=model,
+        openai_api_key=api_key,
+        temperature=0.3,
+        http_async_client=get_async_http_client(),
+    )
     # LangChain's ChatOpenAI expects a list of messages
     response = await llm.ainvoke([HumanMessage(content=prompt)])
     return response.content
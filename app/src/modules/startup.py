@@ -0,0 +1,23 @@
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("startup")
+
+# name -> seconds, for the startup steps and the clients created on first use
+timings = {}
+
+
+@contextmanager
+def timed(name: str):
+    """Record how long importing or initializing a dependency took"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - started
+        logger.info(f"{name} took {timings[name] * 1000:.0f}ms")
+
+
+def report() -> str:
+    return ", ".join(f"{name}: {seconds * 1000:.0f}ms" for name, seconds in timings.items())
@@ -0,0 +1,289 @@
+import json
+import logging
+import re
+from typing import List, NamedTuple, Optional
+
+from fastapi import HTTPException
+from langchain_core.documents import Document
+from sqlalchemy import text
+
+from app.src import constants
+
+logger = logging.getLogger("vector_index")
+
+INDEX_METHODS = ("hnsw", "ivfflat")
+VECTOR_TYPES = ("vector", "halfvec")
+INDEX_PREFIX = "lpe_ann"
+# Index names encode everything a search needs to hit the index expression:
+# lpe_ann_<method>_<vector type>_<dimensions>_<collection uuid hex>
+INDEX_NAME_PATTERN = re.compile(
+    rf"^{INDEX_PREFIX}_(hnsw|ivfflat)_(vector|halfvec)_(\d+)_([0-9a-f]{{32}})$")
+# pgvector indexes up to 2000 dimensions as vector and 4000 as halfvec
+MAX_VECTOR_DIMENSIONS = 2000
+MAX_HALFVEC_DIMENSIONS = 4000
+
+
+class VectorIndex(NamedTuple):
+    name: str
+    method: str
+    vector_type: str
+    dimensions: int
+    collection_id: str
+
+    @property
+    def column_type(self) -> str:
+        return f"{self.vector_type}({self.dimensions})"
+
+
+def parse_index_name(index_name: str) -> Optional[VectorIndex]:
+    match = INDEX_NAME_PATTERN.match(index_name)
+    if match is None:
+        return None
+    method, vector_type, dimensions, collection_hex = match.groups()
+    collection_id = (f"{collection_hex[:8]}-{collection_hex[8:12]}-{collection_hex[12:16]}-"
+                     f"{collection_hex[16:20]}-{collection_hex[20:]}")
+    return VectorIndex(index_name, method, vector_type, int(dimensions), collection_id)
+
+
+def is_containment_filter(search_filter: Optional[dict]) -> bool:
+    """True if the filter only has plain key == value conditions, which map to cmetadata @> filter"""
+    if not search_filter:
+        return True
+    return all(not key.startswith("$") and isinstance(value, (str, int, float, bool))
+               for key, value in search_filter.items())
+
+
+class VectorIndexManager:
+    """Creates, rebuilds and reports the per-collection ANN indexes of langchain_pg_embedding.
+
+    pgvector can't index the untyped embedding column, so each index is a partial
+    index on a typed cast of the column, and searches have to order by the same
+    expression to use it (see search()).
+    """
+
+    def __init__(self, engine) -> None:
+        self.engine = engine
+
+    async def get_collection_id(self, conn, collection_name: str) -> str:
+        result = await conn.execute(
+            text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"),
+            {"name": collection_name})
+        row = result.first()
+        if row is None:
+            raise HTTPException(
+                status_code=404, detail=f"Collection {collection_name} not found")
+        return str(row[0])
+
+    async def list_indexes(self) -> List[VectorIndex]:
+        """Valid ANN indexes, an index whose concurrent build failed is skipped"""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(text('''
+                SELECT c.relname
+                FROM pg_index ix
+                JOIN pg_class c ON c.oid = ix.indexrelid
+                WHERE ix.indrelid = 'langchain_pg_embedding'::regclass
+                AND ix.indisvalid
+                AND c.relname LIKE :prefix
+            '''), {"prefix": f"{INDEX_PREFIX}_%"})
+            names = [row[0] for row in result]
+        return [index for index in map(parse_index_name, names) if index is not None]
+
+    async def find_index(self, collection_name: str) -> Optional[VectorIndex]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"),
+                {"name": collection_name})
+            row = result.first()
+        if row is None:
+            return None
+        collection_id = str(row[0])
+        for index in await self.list_indexes():
+            if index.collection_id == collection_id:
+                return index
+        return None
+
+    async def create_index(self, collection_name: str, method: str = "hnsw", m: Optional[int] = None,
+                           ef_construction: Optional[int] = None, lists: Optional[int] = None,
+                           vector_type: Optional[str] = None) -> str:
+        """Build the ANN index of a collection without blocking writes, replacing any existing one
+
+        vector_type picks the precision the index stores, halfvec halves the index
+        size. By default vector is used when the dimensions allow it.
+        """
+        if method not in INDEX_METHODS:
+            raise HTTPException(
+                status_code=400, detail=f"Index method must be one of {INDEX_METHODS}")
+        if vector_type is not None and vector_type not in VECTOR_TYPES:
+            raise HTTPException(
+                status_code=400, detail=f"Vector type must be one of {VECTOR_TYPES}")
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            collection_id = await self.get_collection_id(conn, collection_name)
+            result = await conn.execute(text('''
+                SELECT vector_dims(embedding), count(*) OVER ()
+                FROM langchain_pg_embedding
+                WHERE collection_id = CAST(:collection_id AS uuid)
+                LIMIT 1
+            '''), {"collection_id": collection_id})
+            row = result.first()
+            if row is None:
+                raise HTTPException(
+                    status_code=400, detail=f"Collection {collection_name} has no embeddings to index")
+            dimensions, row_count = row
+            if vector_type is None:
+                vector_type = "vector" if dimensions <= MAX_VECTOR_DIMENSIONS else "halfvec"
+            max_dimensions = MAX_VECTOR_DIMENSIONS if vector_type == "vector" else MAX_HALFVEC_DIMENSIONS
+            if dimensions > max_dimensions:
+                raise HTTPException(
+                    status_code=400, detail=f"{dimensions} dimensions is too many to index as {vector_type}")
+
+            if method == "hnsw":
+                options = (f"m = {int(m or constants.VECTOR_INDEX_HNSW_M)}, "
+                           f"ef_construction = {int(ef_construction or constants.VECTOR_INDEX_HNSW_EF_CONSTRUCTION)}")
+            else:
+                # pgvector suggests rows / 1000 lists up to a million rows
+                options = f"lists = {int(lists or max(10, row_count // 1000))}"
+
+            index_name = f"{INDEX_PREFIX}_{method}_{vector_type}_{dimensions}_{collection_id.replace('-', '')}"
+            previous = [index for index in await self.all_collection_indexes(conn, collection_id)
+                        if index != index_name]
+
+            # IF NOT EXISTS would keep an index left invalid by a failed or killed build
+            state = await self.index_state(conn, index_name)
+            if state == "building":
+                raise HTTPException(status_code=409, detail=f"{index_name} is already being built")
+            if state == "invalid":
+                logger.warning(f"Dropping {index_name}, left invalid by a failed build")
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+
+            logger.info(f"Creating {index_name} ({options}) over {row_count} embeddings")
+            try:
+                await conn.execute(text(f'''
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name}
+                    ON langchain_pg_embedding
+                    USING {method} ((embedding::{vector_type}({dimensions})) {vector_type}_cosine_ops)
+                    WITH ({options})
+                    WHERE collection_id = '{collection_id}'::uuid
+                '''))
+            except Exception:
+                logger.error(f"Building {index_name} failed, dropping what it left")
+                try:
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+                except Exception as err:
+                    # The next build drops it
+                    logger.error(f"Could not drop {index_name}: {err}")
+                raise
+            state = await self.index_state(conn, index_name)
+            if state != "valid":
+                raise HTTPException(status_code=500, detail=f"{index_name} is {state} after its build")
+            for old_index in previous:
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {old_index}"))
+            logger.info(f"Created {index_name}")
+        return index_name
+
+    async def index_state(self, conn, index_name: str) -> str:
+        """missing, valid, building (a concurrent build is running) or invalid"""
+        result = await conn.execute(text('''
+            SELECT ix.indisvalid,
+                   EXISTS (SELECT 1 FROM pg_stat_progress_create_index p
+                           WHERE p.index_relid = ix.indexrelid)
+            FROM pg_index ix
+            JOIN pg_class c ON c.oid = ix.indexrelid
+            WHERE c.relname = :name AND c.relnamespace = 'public'::regnamespace
+        '''), {"name": index_name})
+        row = result.first()
+        if row is None:
+            return "missing"
+        valid, building = row
+        if valid:
+            return "valid"
+        return "building" if building else "invalid"
+
+    async def all_collection_indexes(self, conn, collection_id: str) -> List[str]:
+        """Names of every ANN index of a collection, including invalid ones"""
+        result = await conn.execute(text('''
+            SELECT indexname FROM pg_indexes
+            WHERE tablename = 'langchain_pg_embedding' AND indexname LIKE :pattern
+        '''), {"pattern": f"{INDEX_PREFIX}_%_{collection_id.replace('-', '')}"})
+        return [row[0] for row in result]
+
+    async def rebuild_index(self, collection_name: str) -> List[str]:
+        """Rebuild the ANN indexes of a collection without blocking writes"""
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            collection_id = await self.get_collection_id(conn, collection_name)
+            index_names = await self.all_collection_indexes(conn, collection_id)
+            for index_name in index_names:
+                logger.info(f"Rebuilding {index_name}")
+                await conn.execute(text(f"REINDEX INDEX CONCURRENTLY {index_name}"))
+        return index_names
+
+    async def drop_index(self, collection_name: str) -> List[str]:
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            collection_id = await self.get_collection_id(conn, collection_name)
+            index_names = await self.all_collection_indexes(conn, collection_id)
+            for index_name in index_names:
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+        return index_names
+
+    async def status(self) -> dict:
+        """Size, validity and usage of every ANN index, and the progress of running builds"""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(text('''
+                SELECT c.relname AS index_name,
+                       ix.indisvalid AS valid,
+                       pg_relation_size(c.oid) AS size_bytes,
+                       pg_size_pretty(pg_relation_size(c.oid)) AS size,
+                       s.idx_scan AS scans
+                FROM pg_index ix
+                JOIN pg_class c ON c.oid = ix.indexrelid
+                LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = ix.indexrelid
+                WHERE ix.indrelid = 'langchain_pg_embedding'::regclass
+                AND c.relname LIKE :prefix
+            '''), {"prefix": f"{INDEX_PREFIX}_%"})
+            indexes = [dict(row._mapping) for row in result]
+            result = await conn.execute(text("SELECT uuid, name FROM langchain_pg_collection"))
+            collections = {str(row[0]): row[1] for row in result}
+            result = await conn.execute(text('''
+                SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total
+                FROM pg_stat_progress_create_index
+                WHERE relid = 'langchain_pg_embedding'::regclass
+            '''))
+            builds = [dict(row._mapping) for row in result]
+
+        for index in indexes:
+            parsed = parse_index_name(index["index_name"])
+            if parsed is not None:
+                index.update(method=parsed.method, vector_type=parsed.vector_type,
+                             dimensions=parsed.dimensions,
+                             collection_name=collections.get(parsed.collection_id))
+        return {"indexes": indexes, "builds_in_progress": builds}
+
+    async def search(self, index: VectorIndex, embedding: List[float], k: int,
+                     search_filter: Optional[dict] = None, ef_search: Optional[int] = None,
+                     probes: Optional[int] = None) -> List[Document]:
+        """Cosine similarity search ordered by the index expression, so the planner can use the index"""
+        column_type = index.column_type
+        async with self.engine.begin() as conn:
+            # set_config(..., true) only lasts for this transaction
+            if ef_search:
+                await conn.execute(text("SELECT set_config('hnsw.ef_search', :value, true)"),
+                                   {"value": str(int(ef_search))})
+            if probes:
+                await conn.execute(text("SELECT set_config('ivfflat.probes', :value, true)"),
+                                   {"value": str(int(probes))})
+            result = await conn.execute(text(f'''
+                SELECT document, cmetadata
+                FROM langchain_pg_embedding
+                WHERE collection_id = '{index.collection_id}'::uuid
+                AND cmetadata @> CAST(:filter AS jsonb)
+                ORDER BY CAST(embedding AS {column_type}) <=> CAST(:embedding AS {column_type})
+                LIMIT :k
+            '''), {
+                "filter": json.dumps(search_filter or {}),
+                "embedding": json.dumps(embedding),
+                "k": k,
+            })
+            rows = result.fetchall()
+        return [Document(page_content=row.document, metadata=row.cmetadata) for row in rows]
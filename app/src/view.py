@@ -6,8 +6,8 @@ import traceback
 from typing import Any, List
 import app.src.constants as constants
 from typing_extensions import Annotated
-from fastapi import Depends, Response, UploadFile, HTTPException, APIRouter, File, Form, Request
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, Response, UploadFile, HTTPException, APIRouter, File, Form, Request, BackgroundTasks, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 
 # from firebase_admin.auth import UserRecord
@@ -20,28 +20,30 @@ from app.src.data_types import (
     UpdateUser,
     Prompt,
     DeleteFile,
+    DeleteFiles,
     ActiveFile,
     TreatmentPlanRequest,
+    VectorIndexRequest,
 )
 from .modules.databases import ConversationDB
+from .modules.ehr_db import EHRDatabase
 from .modules.services import LLMAgentFactory, simple_openai_chat
 from .modules.auth import Authentication
-from .modules.aws import AWS
+from .modules.chat_session import ChatSession
 from dotenv import load_dotenv
 import time
 import os
-from app.src.knowledge_base import new_knowledge_base, create_drug_index, process_file
 from redis import asyncio as aioredis
 import app.src.error_messages as error_messages
 from app.src.modules.databases import PGVectorManager
+from app.src.modules.cache import get_encounter_cache, jsonable
+from app.src.modules.embeddings import get_query_embedding_cache
 from pydantic import BaseModel
-import mysql.connector
 from datetime import datetime, date
 import subprocess
 import tempfile
 from fastapi.responses import FileResponse, Response
 from io import BytesIO
-from jinja2 import Template, Environment
 import random
 import string
 
@@ -55,7 +57,8 @@ router = APIRouter()
 
 origins = ["*"]
 
-# Connect To Database
+# Neither connects here: the pool is opened by the app lifespan and the redis
+# client connects on its first command
 db = ConversationDB()
 REDIS_URL = os.environ.get("REDIS_URL")
 redis = aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
@@ -95,6 +98,53 @@ async def get_home_page():
     return f"Hello this is the {PROJECT_NAME} backend"
 
 
+def get_request_user_id(query: Query, request: Request):
+    """User of a chat request, from the userId header or the request body"""
+    user_id = request.headers.get("userId")
+    if user_id:
+        try:
+            user_id = int(user_id)
+            logger.info(f"Using user ID from header: {user_id}")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid user ID in header")
+    else:
+        # Fallback to request body user ID if not in header
+        user_id = int(query.userId) if getattr(query, "userId", None) not in (None, "") else None
+        logger.warning(f"Using user ID from request body: {user_id} (consider using header)")
+
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="No valid user ID found")
+    return user_id
+
+
+async def get_conversation_history(query: Query, user_id):
+    """Conversation of a chat request, started if the request has none, and its history"""
+    # if current_user.custom_claims.get('local_id') is not None:
+    #     user_id = current_user.custom_claims.get('local_id')
+    #     logger.info(f"Current user's local id: {user_id}")
+    conversation_id = None
+
+    if not query.convo_id:  # Check if 'chat_history' is not present or empty
+        conversation_id = await db.insert_conversation(user_id, query.input)
+        logger.info(f"new Conversation ID: {conversation_id}")
+    else:
+        conversation_id = query.convo_id
+
+    # If chat_history is not provided, fetch it from the database
+    chat_history = query.chat_history
+    if chat_history is None and conversation_id:
+        conversation_rows = await db.get_conversation(conversation_id)
+        chat_history = []
+        for row in conversation_rows:
+            chat_history.append(
+                {
+                    "prompt": row[2],  # Question column
+                    "response": row[3],  # Answer column
+                }
+            )
+    return str(conversation_id), chat_history
+
+
 @router.post("/generate", response_class=HTMLResponse)
 async def get_chatbot_response(query: Query, request: Request):
     """route definition for chatbot"""
@@ -102,62 +152,17 @@ async def get_chatbot_response(query: Query, request: Request):
         start_time = time.time()
         logger.info(f"User's query: {query.input}")
         logger.info(f"Language: {query.language}")
-        
-        # Get user ID from request header
-        user_id = request.headers.get("userId")
-        if user_id:
-            try:
-                user_id = int(user_id)
-                logger.info(f"Using user ID from header: {user_id}")
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid user ID in header")
-        else:
-            # Fallback to request body user ID if not in header
-            user_id = int(query.userId) if getattr(query, "userId", None) not in (None, "") else None
-            logger.warning(f"Using user ID from request body: {user_id} (consider using header)")
-        
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="No valid user ID found")
-        
-        llm = await LLMAgentFactory().create()
+
+        user_id = get_request_user_id(query, request)
+
+        llm = await LLMAgentFactory().create(query.language)
         if type(llm) == str:
             return llm
-        
-        await llm._build_prompt(query.language)
-        
-        # Set the user_id for the agent if it's an OPENAIAgent
-        if hasattr(llm, 'set_user_id') and user_id is not None:
-            llm.set_user_id(user_id)
-            logger.info(f"Set user_id {user_id} for LLM agent")
-        
-        await llm._create_agent()
 
-        # if current_user.custom_claims.get('local_id') is not None:
-        #     user_id = current_user.custom_claims.get('local_id')
-        #     logger.info(f"Current user's local id: {user_id}")
-        conversation_id = None
-
-        if not query.convo_id:  # Check if 'chat_history' is not present or empty
-            conversation_id = await db.insert_conversation(user_id, query.input)
-            logger.info(f"new Conversation ID: {conversation_id}")
-        else:
-            conversation_id = query.convo_id
-
-        # If chat_history is not provided, fetch it from the database
-        chat_history = query.chat_history
-        if chat_history is None and conversation_id:
-            conversation_rows = await db.get_conversation(conversation_id)
-            chat_history = []
-            for row in conversation_rows:
-                chat_history.append(
-                    {
-                        "prompt": row[2],  # Question column
-                        "response": row[3],  # Answer column
-                    }
-                )
+        conversation_id, chat_history = await get_conversation_history(query, user_id)
 
         # chatbot's response - use original query without embedding user_id in prompt
-        response, context = await llm.qa(query.input, chat_history)
+        response, context = await llm.qa(query.input, chat_history, user_id=user_id)
         end_time = time.time()
         response_time = end_time - start_time
         conversation_id = json.dumps(str(conversation_id))
@@ -187,13 +192,135 @@ async def get_chatbot_response(query: Query, request: Request):
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def chat_turn_events(llm, query_input, chat_history, user_id, conversation_id, start_time):
+    """(event, data) of a streamed chat turn, ending with done once the query is stored"""
+    response, context = "", ""
+    if hasattr(llm, "stream"):
+        async for event, data in llm.stream(query_input, chat_history, user_id=user_id):
+            if event == "end":
+                response, context = data["response"], data["context"]
+            else:
+                yield event, data
+    else:
+        response, context = await llm.qa(query_input, chat_history, user_id=user_id)
+
+    # Stored once the answer is complete, like /generate
+    query_id = await db.insert_query(
+        conversation_id,
+        query_input,
+        response,
+        context,
+        time.time() - start_time,
+        user_id=user_id,
+    )
+    yield "done", {"response": response, "query_id": str(query_id), "convo_id": conversation_id}
+
+
+@router.post("/generate/stream")
+async def stream_chatbot_response(query: Query, request: Request):
+    """/generate as Server-Sent Events: conversation, tool_start, tool_end, sources
+    and token events while the agent runs, then done with the stored query's id"""
+    start_time = time.time()
+    logger.info(f"User's query (streamed): {query.input}")
+    user_id = get_request_user_id(query, request)
+
+    llm = await LLMAgentFactory().create(query.language)
+    if type(llm) == str:
+        raise HTTPException(status_code=400, detail=llm)
+
+    try:
+        conversation_id, chat_history = await get_conversation_history(query, user_id)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def events():
+        yield sse_event("conversation", {"convo_id": conversation_id})
+        try:
+            async for event, data in chat_turn_events(
+                llm, query.input, chat_history, user_id, conversation_id, start_time
+            ):
+                yield sse_event(event, data)
+        except Exception:
+            logger.error(traceback.format_exc())
+            yield sse_event("error", {"detail": error_messages.CHAT_TURN_FAILED})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # No caching or proxy buffering of the events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """Chat over a WebSocket. The user id comes from the userId header or query
+    parameter. Each message is {"input", "language", "convo_id"}, convo_id only
+    read on the first one to resume a conversation, and gets the events of
+    /generate/stream back as {"event": ..., **data} messages."""
+    user_id = websocket.headers.get("userId") or websocket.query_params.get("userId")
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        await websocket.close(code=1008, reason="No valid user ID found")
+        return
+
+    await websocket.accept()
+    session = ChatSession(user_id)
+    try:
+        while True:
+            # A malformed frame gets an error event, the session and its history stay
+            try:
+                message = json.loads(await websocket.receive_text())
+            except (ValueError, KeyError):
+                # KeyError: binary frames have no text
+                await websocket.send_json({"event": "error", "detail": error_messages.INVALID_CHAT_MESSAGE})
+                continue
+            start_time = time.time()
+            query_input = message.get("input") if isinstance(message, dict) else None
+            if not query_input:
+                await websocket.send_json({"event": "error", "detail": "input is required"})
+                continue
+            logger.info(f"User's query (websocket): {query_input}")
+
+            try:
+                llm = await session.get_agent(message.get("language"))
+                if type(llm) == str:
+                    await websocket.send_json({"event": "error", "detail": llm})
+                    continue
+                first_turn = session.conversation_id is None
+                conversation_id = await session.start(query_input, message.get("convo_id"))
+                if first_turn:
+                    await websocket.send_json({"event": "conversation", "convo_id": conversation_id})
+
+                response = None
+                async for event, data in chat_turn_events(
+                    llm, query_input, session.history, user_id, conversation_id, start_time
+                ):
+                    await websocket.send_json({"event": event, **data})
+                    if event == "done":
+                        response = data["response"]
+                session.add_turn(query_input, response)
+            except WebSocketDisconnect:
+                raise
+            except Exception:
+                logger.error(traceback.format_exc())
+                await websocket.send_json({"event": "error", "detail": error_messages.CHAT_TURN_FAILED})
+    except WebSocketDisconnect:
+        logger.info(f"Chat websocket of user {user_id} closed, conversation {session.conversation_id}")
+
+
 # @router.get("/check_drug_index")
 # async def check_drug_index():
 #     """Check if the drug index exists and has data"""
 #     try:
 #         pgmanager = PGVectorManager()
-#         stats = pgmanager.get_collection_stats("drug-index")
-#         pgmanager.close()
+#         stats = await pgmanager.get_collection_stats("drug-index")
 #         return stats
 #     except Exception as e:
 #         logger.error(f"Error checking drug index: {str(e)}")
@@ -503,6 +630,9 @@ async def create_knowledge_base(files: Annotated[List[UploadFile], File()]):
         logger.info(type(files))
         logger.info(f"length of files {len(files)}")
         # return
+        # Deferred, the document loaders are heavy and uploads are rare
+        from app.src.knowledge_base import new_knowledge_base
+
         data = await new_knowledge_base(files=files)
         logger.info(f"Data being passed to add_files: {data}")
         _ = await db.add_files(data, user_id=user_id)
@@ -580,6 +710,8 @@ async def list_files():
 @router.post("/delete-file")
 async def delete_file(input: DeleteFile):
     try:
+        from .modules.aws import AWS
+
         aws = AWS()
         aws.delete_file(input.file_name)
         _ = await db.delete_file(input.file_name)
@@ -592,6 +724,24 @@ async def delete_file(input: DeleteFile):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/delete-files")
+async def delete_files(input: DeleteFiles):
+    try:
+        from .modules.aws import AWS
+
+        aws = AWS()
+        for file_name in input.file_names:
+            aws.delete_file(file_name)
+        _ = await db.delete_files(input.file_names)
+        _ = await db.delete_files_embeddings(input.file_names, input.collection_name)
+        return {
+            "message": f"{len(input.file_names)} Files Deleted Successfully",
+        }
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # @router.post("/clean-drug-index")
 # async def clean_drug_index():
 #     """
@@ -696,6 +846,150 @@ async def get_prompt(current_user: Annotated[Any, Depends(get_current_user)]):
             raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/embedding-cache-stats")
+async def get_embedding_cache_stats(
+    current_user: Annotated[Any, Depends(get_current_user)],
+):
+    """hit/miss counters of the query embedding cache of this worker"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    return get_query_embedding_cache().get_stats()
+
+
+@router.get("/encounter-cache-stats")
+async def get_encounter_cache_stats(
+    current_user: Annotated[Any, Depends(get_current_user)],
+):
+    """hit/miss counters of the encounter data cache of this worker"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    return get_encounter_cache().get_stats()
+
+
+@router.delete("/encounter-cache/{patient_id}")
+async def invalidate_encounter_cache(patient_id: int):
+    """Called by the EHR after it writes to a patient's record, unauthenticated like /treatment-plan"""
+    try:
+        await get_encounter_cache().invalidate(patient_id)
+        return {"patient_id": patient_id, "invalidated": True}
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/collection-stats")
+async def get_collections(current_user: Annotated[Any, Depends(get_current_user)]):
+    """chunk count of every collection of the vector store"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    try:
+        return await PGVectorManager().list_collections()
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/collection-stats/{collection_name}")
+async def get_collection_stats(
+    collection_name: str, current_user: Annotated[Any, Depends(get_current_user)]
+):
+    """chunk counts, sizes and last ingestion of a collection, per source file"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    stats = await PGVectorManager().get_collection_stats(collection_name)
+    if "error" in stats:
+        raise HTTPException(status_code=500, detail=stats["error"])
+    return stats
+
+
+@router.get("/embedding-indexes")
+async def get_embedding_indexes(current_user: Annotated[Any, Depends(get_current_user)]):
+    """usage of the metadata, full text and ANN indexes of the embedding table"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    try:
+        return await PGVectorManager().embedding_index_usage()
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/vector-indexes")
+async def get_vector_indexes(current_user: Annotated[Any, Depends(get_current_user)]):
+    """status and size of the ANN indexes of the vector store"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    try:
+        return await PGVectorManager().get_index_manager().status()
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def build_vector_index(data: VectorIndexRequest, rebuild: bool):
+    pgmanager = PGVectorManager()
+    try:
+        if rebuild:
+            await pgmanager.get_index_manager().rebuild_index(data.collection_name)
+        else:
+            await pgmanager.get_index_manager().create_index(
+                data.collection_name,
+                method=data.method,
+                m=data.m,
+                ef_construction=data.ef_construction,
+                lists=data.lists,
+                vector_type=data.vector_type,
+            )
+        pgmanager.forget_ann_index(data.collection_name)
+    except Exception:
+        logger.error(f"Index build for {data.collection_name} failed")
+        logger.error(traceback.format_exc())
+
+
+@router.post("/vector-indexes")
+async def create_vector_index(
+    data: VectorIndexRequest,
+    background_tasks: BackgroundTasks,
+    current_user: Annotated[Any, Depends(get_current_user)],
+):
+    """build (or replace) the ANN index of a collection in the background"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    background_tasks.add_task(build_vector_index, data, rebuild=False)
+    return {"message": f"Index build for {data.collection_name} started, see GET /vector-indexes"}
+
+
+@router.post("/vector-indexes/rebuild")
+async def rebuild_vector_index(
+    data: VectorIndexRequest,
+    background_tasks: BackgroundTasks,
+    current_user: Annotated[Any, Depends(get_current_user)],
+):
+    """rebuild the ANN index of a collection in the background"""
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    background_tasks.add_task(build_vector_index, data, rebuild=True)
+    return {"message": f"Index rebuild for {data.collection_name} started, see GET /vector-indexes"}
+
+
+@router.delete("/vector-indexes/{collection_name}")
+async def drop_vector_index(
+    collection_name: str, current_user: Annotated[Any, Depends(get_current_user)]
+):
+    if current_user.custom_claims.get("role") != "Admin":
+        raise HTTPException(status_code=401, detail="Unauthorised")
+    try:
+        pgmanager = PGVectorManager()
+        dropped = await pgmanager.get_index_manager().drop_index(collection_name)
+        pgmanager.forget_ann_index(collection_name)
+        return {"dropped": dropped}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # @router.post("/drug_index")
 # async def drug_index_endpoint(files: Annotated[List[UploadFile], File()]):
 #     try:
@@ -786,8 +1080,6 @@ def filter_patient_data(
     problems,
     medications,
     vitals,
-    laboratory,
-    family_history,
     doctor_name=None,
     doctor_id=None,
 ):
@@ -910,56 +1202,24 @@ async def generate_treatment_plan(request: TreatmentPlanRequest):
 
     try:
         t0 = time.time()
-        global mysql_connection
-        if mysql_connection is None or not mysql_connection.is_connected():
-            init_mysql_connection()
-        connection = mysql_connection
         patient_id = request.patient_id
         doctor_name = request.doctor_name
         doctor_id = request.doctor_id
         organization_id = request.organization_id
         reference_number = request.reference_number
-        cursor = connection.cursor(dictionary=True)
-
-        cursor.execute("SELECT * FROM patients WHERE id = %s", (patient_id,))
-        patient = cursor.fetchone()
-
-        cursor.execute("SELECT * FROM allergies WHERE patientId = %s", (patient_id,))
-        allergies = cursor.fetchall()
-
-        cursor.execute("SELECT * FROM problem WHERE patient_id = %s", (patient_id,))
-        problems = cursor.fetchall()
-
-        cursor.execute(
-            "SELECT * FROM patient_medications WHERE patient_id = %s", (patient_id,)
-        )
-        medications = cursor.fetchall()
-
-        cursor.execute("SELECT * FROM vitals WHERE patientId = %s", (patient_id,))
-        vitals = cursor.fetchall()
-
-        cursor.execute("SELECT * FROM laboratory WHERE patientId = %s", (patient_id,))
-        laboratory = cursor.fetchall()
-
-        cursor.execute(
-            "SELECT * FROM family_history WHERE patientId = %s", (patient_id,)
-        )
-        family_history = cursor.fetchall()
-
-        cursor.close()
-
+        record = await EHRDatabase().load_patient_record(patient_id)
         t1 = time.time()
         logger.info(f"MySQL fetch took {t1-t0:.2f}s")
+        if record.patient is None:
+            raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
 
         # Prepare filtered data for template
         filtered_data = filter_patient_data(
-            patient,
-            allergies,
-            problems,
-            medications,
-            vitals,
-            laboratory,
-            family_history,
+            record.patient,
+            record.allergies,
+            record.problems,
+            record.medications,
+            record.vitals,
             doctor_name=doctor_name,
             doctor_id=doctor_id,
         )
@@ -1078,6 +1338,9 @@ async def generate_treatment_plan(request: TreatmentPlanRequest):
 \end{document}
 """
 
+        # Deferred, only this route renders templates
+        from jinja2 import Environment
+
         # Use a safe environment to avoid conflicts with LaTeX
         env = Environment(
             block_start_string="[%",
@@ -1337,27 +1600,14 @@ async def generate_treatment_plan(request: TreatmentPlanRequest):
                 tex_path, filename="treatment_plan.tex", media_type="application/x-tex"
             )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# Global MySQL connection (initialized at startup)
-mysql_connection = None
-
-
-def init_mysql_connection():
-    global mysql_connection
-    if mysql_connection is None or not mysql_connection.is_connected():
-        mysql_connection = mysql.connector.connect(
-            host=os.environ.get("MYSQL_HOST"),
-            user=os.environ.get("MYSQL_USERNAME"),
-            password=os.environ.get("MYSQL_PASSWORD"),
-            database=os.environ.get("MYSQL_DATABASE"),
-        )
-        logger.info("MySQL connection established at startup.")
-
-def extract_encounter_data(user_id):
+async def extract_encounter_data(user_id):
     """
     Extract comprehensive encounter data for a user from database tables.
     This function is called by the LLM when it understands the user wants encounter summaries.
@@ -1370,94 +1620,108 @@ def extract_encounter_data(user_id):
         dict: Comprehensive user encounter data or None if error
     """
     try:
-        global mysql_connection
-        if mysql_connection is None or not mysql_connection.is_connected():
-            init_mysql_connection()
-        
-        connection = mysql_connection
-        cursor = connection.cursor(dictionary=True)
-        
-        cursor.execute("""
-            SELECT id
-            FROM patients
-            WHERE userId = %s
-        """, (user_id,))
-
-        result = cursor.fetchone()  # e.g. {'id': 95}
-        if result is None:
-            return f"No patient record found for user ID {user_id}. Please ensure you have a valid patient account."
-        
-        patient_id = result["id"]
-        # Extract patient encounters (filtered by user_id for security)
-        cursor.execute("""
-            SELECT id, patientId, encounterTypeCode, encounterTypeHistory, 
-                   startDate, endDate, assignedToId, billingTypeCode, 
-                   billingId, duration, additionalFields, soapForm, 
-                   selectedForms, signature, atDraft, isDeleted, isActive, 
-                   createdById, updatedById, deletedById, createdAt, 
-                   updatedAt, isLock, patientName
-            FROM patient_encounters 
-            WHERE patientId = %s AND isDeleted = 0 AND isActive = 1
-            ORDER BY createdAt DESC
-        """, (patient_id,))
-        encounters = cursor.fetchall()
-        
-        # Extract allergies (filtered by user_id for security)
-        cursor.execute("""
-            SELECT allergy, severitiesCode, dateOfOnSet, patientEncounterId, 
-                   comment, isDeleted, isActive, allergiesStatus, allergytype, createdById
-            FROM allergies 
-            WHERE patientId = %s AND isDeleted = 0
-        """, (patient_id,))
-        allergies = cursor.fetchall()
-        
-        # Extract recent vitals (last 5 records, filtered by user_id for security)
-        cursor.execute("""
-            SELECT recordDate, recordTime, weightKilo, weightGram, weightUnit,
-                   heightFt, heightIn, heightUnit, bmi, temperatureF, 
-                   systolicBloodPressure, diastolicBloodPressure, respiratoryRate,
-                   pulseBpm, bloodSugar, fasting, o2Saturation, createdById
-            FROM vitals 
-            WHERE patientId = %s AND isDeleted = 0 AND isActive = 1
-            ORDER BY createdAt DESC
-            LIMIT 5
-        """, (patient_id,))
-        vitals = cursor.fetchall()
-        
-        # Extract current medications (filtered by user_id for security)
-        cursor.execute("""
-            SELECT medicationtype, drugname, drugbrandname, instruction, 
-                   quantity, refill, isallowsubstitution, prescriber, 
-                   prescriberid, doctor_id, startedon, isadministered, 
-                   reason, discontinuecomment, errorcomment, cancelrxcomment,
-                   dose, unit, route, frequency, duration, direction, comment, createdby
-            FROM patient_medications 
-            WHERE patient_id = %s AND isdeleted = 0 AND isactive = 1
-        """, (patient_id,))
-        medications = cursor.fetchall()
-        
-        cursor.close()
-        
-        # Structure the comprehensive encounter data
-        encounter_data = {
-            "user_id": user_id,
-            "patient_id": patient_id,
-            "total_encounters": len(encounters),
-            "encounters": encounters,
-            "allergies": allergies,
-            "recent_vitals": vitals,
-            "current_medications": medications,
-            "data_extracted_at": datetime.now().isoformat()
-        }
-        
-        logger.info(f"Successfully extracted encounter data for patient with patient_id {patient_id}")
+        cache = get_encounter_cache()
+        patient_id = cache.get_patient_id(user_id)
+        if patient_id is not None:
+            key = await cache.key(patient_id)
+            encounter_data = await cache.get(key)
+            if encounter_data is not None:
+                logger.info(f"Encounter data of patient {patient_id} served from cache")
+                return encounter_data
+
+        async with EHRDatabase().cursor() as cursor:
+            if patient_id is None:
+                patient_id = await fetch_patient_id(cursor, user_id)
+                if patient_id is None:
+                    return f"No patient record found for user ID {user_id}. Please ensure you have a valid patient account."
+                cache.set_patient_id(user_id, patient_id)
+                key = await cache.key(patient_id)
+            encounter_data = jsonable(await fetch_encounter_data(cursor, user_id, patient_id))
+        await cache.set(key, encounter_data)
         return encounter_data
-        
     except Exception as e:
         logger.error(f"Error extracting encounter data for user_id {user_id}: {str(e)}")
         logger.error(traceback.format_exc())
         return f"Error retrieving encounter data: {str(e)}"
-        
+
+
+async def fetch_patient_id(cursor, user_id):
+    await cursor.execute("""
+        SELECT id
+        FROM patients
+        WHERE userId = %s
+    """, (user_id,))
+
+    result = await cursor.fetchone()  # e.g. {'id': 95}
+    return result["id"] if result is not None else None
+
+
+async def fetch_encounter_data(cursor, user_id, patient_id):
+    """Encounters, allergies, recent vitals and medications of a patient"""
+    # Extract patient encounters (filtered by user_id for security)
+    await cursor.execute("""
+        SELECT id, patientId, encounterTypeCode, encounterTypeHistory, 
+               startDate, endDate, assignedToId, billingTypeCode, 
+               billingId, duration, additionalFields, soapForm, 
+               selectedForms, signature, atDraft, isDeleted, isActive, 
+               createdById, updatedById, deletedById, createdAt, 
+               updatedAt, isLock, patientName
+        FROM patient_encounters 
+        WHERE patientId = %s AND isDeleted = 0 AND isActive = 1
+        ORDER BY createdAt DESC
+    """, (patient_id,))
+    encounters = await cursor.fetchall()
+    
+    # Extract allergies (filtered by user_id for security)
+    await cursor.execute("""
+        SELECT allergy, severitiesCode, dateOfOnSet, patientEncounterId, 
+               comment, isDeleted, isActive, allergiesStatus, allergytype, createdById
+        FROM allergies 
+        WHERE patientId = %s AND isDeleted = 0
+    """, (patient_id,))
+    allergies = await cursor.fetchall()
+    
+    # Extract recent vitals (last 5 records, filtered by user_id for security)
+    await cursor.execute("""
+        SELECT recordDate, recordTime, weightKilo, weightGram, weightUnit,
+               heightFt, heightIn, heightUnit, bmi, temperatureF, 
+               systolicBloodPressure, diastolicBloodPressure, respiratoryRate,
+               pulseBpm, bloodSugar, fasting, o2Saturation, createdById
+        FROM vitals 
+        WHERE patientId = %s AND isDeleted = 0 AND isActive = 1
+        ORDER BY createdAt DESC
+        LIMIT 5
+    """, (patient_id,))
+    vitals = await cursor.fetchall()
+    
+    # Extract current medications (filtered by user_id for security)
+    await cursor.execute("""
+        SELECT medicationtype, drugname, drugbrandname, instruction, 
+               quantity, refill, isallowsubstitution, prescriber, 
+               prescriberid, doctor_id, startedon, isadministered, 
+               reason, discontinuecomment, errorcomment, cancelrxcomment,
+               dose, unit, route, frequency, duration, direction, comment, createdby
+        FROM patient_medications 
+        WHERE patient_id = %s AND isdeleted = 0 AND isactive = 1
+    """, (patient_id,))
+    medications = await cursor.fetchall()
+    
+    # Structure the comprehensive encounter data
+    encounter_data = {
+        "user_id": user_id,
+        "patient_id": patient_id,
+        "total_encounters": len(encounters),
+        "encounters": encounters,
+        "allergies": allergies,
+        "recent_vitals": vitals,
+        "current_medications": medications,
+        "data_extracted_at": datetime.now().isoformat()
+    }
+    
+    logger.info(f"Successfully extracted encounter data for patient with patient_id {patient_id}")
+    return encounter_data
+
+
 def replace_underscores(obj):
     if isinstance(obj, dict):
         return {k: replace_underscores(v) for k, v in obj.items()}
@@ -1519,7 +1783,3 @@ def latex_to_pdf(latex_content: str) -> bytes:
     except Exception as e:
         logger.error(f"Error in LaTeX to PDF conversion: {str(e)}")
         raise HTTPException(status_code=500, detail=f"PDF generation failed: {str(e)}")
-
-
-# Initialize MySQL connection at app startup
-init_mysql_connection()